@@ -16,6 +16,8 @@ from flask_moment import Moment
 
 from flask_mail import Mail
 
+from app.push import PushQueue
+
 from config import Config
 
 
@@ -26,6 +28,7 @@ login.login_view = 'auth.login'
 login.login_message = 'Please log in to access this page.'
 mail = Mail()
 moment = Moment()
+push = PushQueue()
 
 def create_app(config_class=Config):
     """Factory function that creates each app instance.
@@ -40,6 +43,10 @@ def create_app(config_class=Config):
     login.init_app(app)
     mail.init_app(app)
     moment.init_app(app)
+    push.init_app(app)
+
+    from app.email import mail_queue
+    mail_queue.init_app(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
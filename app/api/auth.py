@@ -1,4 +1,5 @@
-from flask import g
+from flask import abort, g
+from werkzeug.local import LocalProxy
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from app.models import User
 from app.api.errors import error_response
@@ -20,9 +21,34 @@ def basic_auth_error():
 
 @token_auth.verify_token
 def verify_token(token):
-    g.current_user = User.check_token(token) if token else None
-    return g.current_user is not None
+    """
+    Checks a signed access token from its signature and expiry, or an
+    opaque token against the TokenCache, or the database on a miss,
+    without loading the user, see load_current_user.
+    """
+    g.token_claims = None
+    if token and token.count('.') == 2:
+        g.token_claims = User.check_access_token(token)
+        user_id = g.token_claims['sub'] if g.token_claims else None
+    else:
+        user_id = User.check_token_id(token) if token else None
+    g.current_user_id = user_id
+    g.pop('token_user', None)
+    g.current_user = LocalProxy(load_current_user)
+    return user_id is not None
+
+def load_current_user():
+    """
+    Loads the user of the verified token the first time a route uses
+    g.current_user, then keeps it for the request. A token of a deleted
+    user fails with 401.
+    """
+    if 'token_user' not in g:
+        g.token_user = User.query.get(g.current_user_id)
+        if g.token_user is None:
+            abort(token_auth_error())
+    return g.token_user
 
 @token_auth.error_handler
 def token_auth_error():
-    return error_response(401)
\ No newline at end of file
+    return error_response(401)
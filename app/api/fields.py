@@ -0,0 +1,36 @@
+from flask import abort, request
+from sqlalchemy.orm import load_only
+
+from app.api.errors import bad_request
+
+
+def requested_fields(model):
+    """
+    Reads ?fields=, a comma separated list of model.API_FIELDS.
+
+    Returns None when not given, meaning the default fields.
+    Unknown fields abort with a 400 response.
+    """
+    if 'fields' not in request.args:
+        return None
+    fields = {name for name in request.args['fields'].split(',') if name}
+    unknown = sorted(fields - set(model.API_FIELDS))
+    if unknown:
+        abort(bad_request(f"Unknown fields: {', '.join(unknown)}."))
+    return fields or None
+
+
+def load_fields(query, model, fields, keys=()):
+    """
+    Limits query to the columns backing fields, see model.FIELD_COLUMNS,
+    and the keys it is paged by.
+    """
+    if fields is None:
+        return query
+    columns = {'id', *keys}
+    for name in fields:
+        columns.update(model.FIELD_COLUMNS.get(name, (name,)))
+    return query.options(
+        load_only(*sorted(name for name in columns if name in model.__table__.columns))
+    )
+
@@ -4,6 +4,8 @@ from app.models import User, Post, Message
 from app import db
 from app.api.auth import token_auth
 from app.api.errors import bad_request
+from app.api.fields import load_fields, requested_fields
+from app.api.stream import stream_collection
 from datetime import datetime, timedelta
 from app.email import send_email
 import json
@@ -60,11 +62,29 @@ def get_messages(id, msg_type):
         return jsonify('failure')
     user.last_message_read_time = datetime.utcnow()
     db.session.commit()
+    fields = requested_fields(Message)
+    # Filtered by id rather than through user.messages_received, whose
+    # query stops resolving the user once the route returns, while the
+    # response is still streaming.
     if msg_type == "received":
-        messages = user.messages_received.order_by(Message.timestamp.desc())
+        messages = Message.query.filter_by(recipient_id=user.id)
     if msg_type == "sent":
-        messages = user.messages_sent.order_by(Message.timestamp.desc())
-    data = User.to_collection_dict(messages, None, None, None)
+        messages = Message.query.filter_by(sender_id=user.id)
+    messages = load_fields(messages, Message, fields, keys=('timestamp',))
+    if 'cursor' in request.args or 'per_page' in request.args:
+        per_page = min(request.args.get('per_page', 100, type=int), 100)
+        link_args = {'fields': request.args['fields']} if fields else {}
+        try:
+            data = User.to_cursor_dict(
+                messages, [Message.timestamp, Message.id], per_page,
+                request.args.get('cursor'), 'api.get_messages', descending=True,
+                item_args={'fields': fields}, id=id, msg_type=msg_type, **link_args
+            )
+        except ValueError as error:
+            return bad_request(str(error))
+    else:
+        return stream_collection(messages.order_by(Message.timestamp.desc()),
+                                 item_args={'fields': fields})
     return jsonify(data)
 
 @bp.route('/send/<int:id>/<user_id>/<body>', methods=['POST'])
@@ -0,0 +1,56 @@
+from itertools import islice
+
+from flask import Response, json, request, stream_with_context
+from sqlalchemy.orm.query import Query
+
+from app.models import PaginatedAPIMixin
+
+
+NDJSON = 'application/x-ndjson'
+
+
+def wants_ndjson():
+    """Checks for ?format=ndjson or an Accept: application/x-ndjson header."""
+    return request.args.get('format') == 'ndjson' or any(
+        mimetype == NDJSON for mimetype, quality in request.accept_mimetypes
+    )
+
+
+def generate(items, item_args=None, each=None, ndjson=False, batch_size=500):
+    """
+    Yields the JSON of {"items": [...]}, or with ndjson one item per line,
+    serializing batch_size items at a time so memory use stays flat.
+
+    items: a query, read from a server side cursor, or any iterable
+    each: optional function applied to each item's dict before encoding
+    """
+    if isinstance(items, Query):
+        items = items.yield_per(batch_size)
+    items = iter(items)
+    opened = False
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            break
+        encoded = []
+        for data in PaginatedAPIMixin.items_to_dicts(batch, item_args or {}):
+            if each is not None:
+                each(data)
+            encoded.append(json.dumps(data))
+        if ndjson:
+            yield '\n'.join(encoded) + '\n'
+        else:
+            yield (', ' if opened else '{"items": [') + ', '.join(encoded)
+            opened = True
+    if not ndjson:
+        yield ']}' if opened else '{"items": []}'
+
+
+def stream_collection(items, item_args=None, each=None):
+    """Streams items as JSON, or as NDJSON when asked for, see generate."""
+    ndjson = wants_ndjson()
+    return Response(
+        stream_with_context(generate(items, item_args, each, ndjson)),
+        mimetype=NDJSON if ndjson else 'application/json'
+    )
+
@@ -4,19 +4,55 @@ from app.models import User, Post, Message
 from app import db
 from app.api.auth import token_auth
 from app.api.errors import bad_request
+from app.api.fields import requested_fields
+from app.api.stream import stream_collection
 from datetime import datetime, timedelta
 from app.email import send_email
 import json
 
+MAX_RANGE_DAYS = 366
+
 @bp.route('/tasks/<int:id>/<date>', methods=['GET'])
 @token_auth.login_required
 def tasks(id, date):
+    """
+    Returns the user's tasks for date. ?fields= only trims the response,
+    tasks are loaded whole as expanding the series reads most columns.
+    """
     user = User.query.get_or_404(id)
-    data = User.to_collection_dict(user.get_daily_tasks(date), None, None, None)
-    for task in data['items']:
-        if task['to_date']:
-            task['to_date'] = datetime.strftime(task['to_date'], "%d-%m-%Y")
-    return jsonify(data)
+    return stream_collection(user.get_daily_tasks(date),
+                             item_args={'fields': requested_fields(Post)},
+                             each=format_to_date)
+
+@bp.route('/tasks/<int:id>', methods=['GET'])
+@token_auth.login_required
+def tasks_in_range(id):
+    """
+    Returns the daily tasks for every date from ?from= to ?to=, grouped by
+    date. As for tasks, ?fields= only trims the response.
+    """
+    user = User.query.get_or_404(id)
+    try:
+        start = datetime.strptime(request.args['from'], "%d-%m-%Y")
+        end = datetime.strptime(request.args['to'], "%d-%m-%Y")
+    except (KeyError, ValueError):
+        return bad_request('from and to must be dates in the format dd-mm-YYYY.')
+    if end < start:
+        return bad_request('from must not be later than to.')
+    if (end - start).days >= MAX_RANGE_DAYS:
+        return bad_request(f'The range must be shorter than {MAX_RANGE_DAYS} days.')
+    fields = requested_fields(Post)
+    days = {}
+    for day, day_tasks in user.get_tasks_in_range(start, end).items():
+        items = [task.to_dict(fields) for task in day_tasks]
+        for task in items:
+            format_to_date(task)
+        days[datetime.strftime(day, "%d-%m-%Y")] = {'items': items}
+    return jsonify({
+        'from': request.args['from'],
+        'to': request.args['to'],
+        'days': days
+    })
 
 @bp.route('/tasks/<int:id>', methods=['PUT'])
 @token_auth.login_required
@@ -26,6 +62,8 @@ def update_task(id):
     data = request.get_json() or {}
     if check_start_and_end(data, task=task) is True:
         return bad_request('The start time must be earlier than the end time.')
+    refresh_from = user.series_start(task)
+    edited_days = [task.date]
     if data['to_date']:
         reformated_date = datetime.strptime(data['to_date'], "%d-%m-%Y")
         reformated_date = datetime.strftime(reformated_date, "%Y-%m-%d, 00:00:00")
@@ -46,35 +84,41 @@ def update_task(id):
             if task.date == new_task.date:
                 task.done = True
             db.session.add(new_task)
+            edited_days.append(new_task.date)
     else:
         if task.exclude:
             parent_task = Post.query.get_or_404(task.exclude)
-            if not parent_task.to_date:
+            data['frequency'] = parent_task.api_frequency_update(data['frequency'])
+            if parent_task.is_rule():
                 parent_task.frequency = data['frequency']
-            tasks = [todo for todo in user.posts.all() if todo.exclude == task.exclude]
-            for i, todo in enumerate(tasks):
-                todo.body = data['body']
-                todo.done = data['done']
-                if data['done'] is True:
-                    todo.frequency = 0
-                elif data['frequency'] and int(data['frequency'])  == 0:
-                    if i != len(tasks) - 1:
-                        todo.done = True
-                elif data['frequency'] and int(data['frequency']) > 0 and ((parent_task.date - todo.date).days % int(data['frequency']) != 0):
-                    todo.done = True
-                todo.color = data['color']
-                todo.start_time = int(data['start_time'])
-                todo.end_time = int(data['end_time'])
+            Post.update_series(
+                user.id,
+                task.exclude,
+                {
+                    'body': data['body'],
+                    'color': data['color'],
+                    'start_time': int(data['start_time']),
+                    'end_time': int(data['end_time'])
+                },
+                done=data['done'],
+                frequency=int(data['frequency']) if data['frequency'] else None,
+                parent_date=parent_task.date
+            )
         else:
+            data['frequency'] = task.api_frequency_update(data['frequency'])
             if data['done'] is True:
                 data['frequency'] = 0
             task.from_dict(data)
+    user.sync_occurrences(task)
+    if data['single_event']:
+        user.refresh_completion_days(task.date, *edited_days)
+    else:
+        user.refresh_completion(min(refresh_from, task.date))
     db.session.commit()
     return jsonify(task.to_dict())
 
 @bp.route('/tasks/<int:ident>/<date>', methods=['POST'])
 def create_task(ident, date):
-    frequency_days = 1
     data = request.get_json() or {}
     if check_start_and_end(data) is True:
         return bad_request('The start time must be earlier than the end time.')
@@ -83,33 +127,26 @@ def create_task(ident, date):
     data['hour'] = 1    
     if data['frequency'] and data['frequency'] != 0:
         data['frequency'] = int(data['frequency'])
-        inc = data['frequency']
     else:
         data['frequency'] = None
-        inc = 1
     if 'done' in data and data['done'] is True:
         data['frequency'] = None
     if data['to_date'] and data['frequency']:
         reformated_date = datetime.strptime(data['to_date'], "%d-%m-%Y")
         reformated_date = datetime.strftime(reformated_date, "%Y-%m-%d, 00:00:00")
         data['to_date'] = datetime.strptime(reformated_date, "%Y-%m-%d, %H:%M:%S")
-        frequency_days = (data['to_date'] - data['date']).days + 1
-        data['frequency'] = None
     else:
         data['to_date'] = None
-    for i in range(0, frequency_days, inc):
-        data['date'] = data['date'] + timedelta(days=i)
-        task = Post()
-        task.from_dict(data)
-        db.session.add(task)
-        db.session.commit()
-        db.session.flush()
-        if i == 0:
-            identifier = task.id
-        if frequency_days > 1:
-            task.exclude = identifier
-            db.session.commit()
+    if data['to_date'] and data['to_date'] < data['date']:
+        return bad_request('The to date must not be earlier than the date.')
+    task = Post()
+    task.from_dict(data)
+    db.session.add(task)
+    db.session.flush()
     user = User.query.get_or_404(ident)
+    user.sync_occurrences(task)
+    user.refresh_completion(datetime.strptime(date, "%d-%m-%Y"))
+    db.session.commit()
     data = User.to_collection_dict(user.get_daily_tasks(date), None, None, None)
     return data
 
@@ -120,3 +157,7 @@ def check_start_and_end(data, task=None):
         return True
     elif 'end_time' in data and task and int(data['end_time']) < task.start_time:
         return True
+
+def format_to_date(task):
+    if task.get('to_date'):
+        task['to_date'] = datetime.strftime(task['to_date'], "%d-%m-%Y")
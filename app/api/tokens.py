@@ -1,12 +1,19 @@
-from flask import jsonify, g
+from flask import current_app, jsonify, g, request
 from app import db
 from app.api import bp
 from app.api.auth import basic_auth
 from app.api.auth import token_auth
+from app.api.errors import error_response
+from app.models import DeniedToken, RefreshToken
+from app.token_cache import token_cache
 
 @bp.route('/tokens', methods=['POST'])
 @basic_auth.login_required
 def get_token():
+    if current_app.config.get('API_TOKEN_MODE', 'opaque') == 'jwt':
+        data = signed_tokens(g.current_user, *RefreshToken.issue(g.current_user))
+        db.session.commit()
+        return jsonify(data)
     token = g.current_user.get_token()
     ident = g.current_user.id
     db.session.commit()
@@ -15,6 +22,47 @@ def get_token():
 @bp.route('/tokens', methods=['DELETE'])
 @token_auth.login_required
 def revoke_token():
-    g.current_user.revoke_token()
+    """
+    Revokes the token used, for a signed access token also the refresh
+    tokens of its login session, leaving the user's other devices signed in.
+    """
+    if g.token_claims:
+        DeniedToken.deny(g.token_claims['jti'], g.token_claims['exp'])
+        if 'fam' in g.token_claims:
+            RefreshToken.revoke_family(g.token_claims['fam'])
+        else:
+            RefreshToken.revoke_user(g.token_claims['sub'])
+    else:
+        g.current_user.revoke_token()
     db.session.commit()
-    return '', 204
\ No newline at end of file
+    return '', 204
+
+@bp.route('/tokens/refresh', methods=['POST'])
+def refresh_token():
+    """
+    Exchanges a refresh token for a new access and refresh token.
+    Each refresh token can only be exchanged once.
+    """
+    data = request.get_json() or {}
+    rotated = RefreshToken.rotate(str(data.get('refresh_token', '')))
+    if rotated is None:
+        db.session.commit()
+        return error_response(401)
+    data = signed_tokens(*rotated)
+    db.session.commit()
+    return jsonify(data)
+
+def signed_tokens(user, refresh, family):
+    """The token response of signed access token mode, see API_TOKEN_MODE."""
+    return {
+        'token': user.get_access_token(family=family),
+        'refresh_token': refresh,
+        'expires_in': current_app.config.get('JWT_ACCESS_EXPIRY', 900),
+        'id': user.id
+    }
+
+@bp.route('/tokens/cache', methods=['GET'])
+@token_auth.login_required
+def token_cache_stats():
+    """Returns the token cache hit and miss counts, hit ratio and size."""
+    return jsonify(token_cache.stats())
@@ -1,62 +1,147 @@
 from app.api import bp
-from flask import jsonify, request, url_for, g, abort, current_app, render_template
+from flask import jsonify, request, url_for, g, abort, current_app, render_template, \
+    redirect, send_file
 from app.models import User, Post, Message
 from app import db
 from app.api.auth import token_auth
 from app.api.errors import bad_request
+from app.api.tasks import MAX_RANGE_DAYS
+from app.depression import summarise
 from datetime import datetime, timedelta
 from app.email import send_email
+from app.api.fields import load_fields, requested_fields
+from app.images import image_digest, image_path
 import json
 
+IMAGE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+MAX_IDS = 100
+
+
+def user_args():
+    """
+    Reads the ?inline_images=1 flag that opts in to base64 images
+    and the ?fields= of the user representations.
+    """
+    return {
+        'inline_image': request.args.get('inline_images', 0, type=int) == 1,
+        'fields': requested_fields(User)
+    }
+
+
+def link_args():
+    """Keeps the inline images flag and fields on pagination links."""
+    args = {}
+    if user_args()['inline_image']:
+        args['inline_images'] = 1
+    if 'fields' in request.args:
+        args['fields'] = request.args['fields']
+    return args
+
+
+def users_query(query):
+    """Loads only the columns of the requested fields and the cursor keys."""
+    return load_fields(query, User, requested_fields(User), keys=('username',))
+
+
+def users_page(query, endpoint, **kwargs):
+    """
+    Pages users by offset with ?page=, or when ?cursor= is given (empty
+    for the first page) with a (username, id) cursor instead.
+    """
+    per_page = min(request.args.get('per_page', 100, type=int), 100)
+    if 'cursor' in request.args:
+        try:
+            return User.to_cursor_dict(users_query(query), [User.username, User.id],
+                                       per_page, request.args['cursor'], endpoint,
+                                       item_args=user_args(), **kwargs, **link_args())
+        except ValueError as error:
+            abort(bad_request(str(error)))
+    return User.to_collection_dict(users_query(query),
+                                   request.args.get('page', 1, type=int),
+                                   per_page, endpoint, item_args=user_args(),
+                                   **kwargs, **link_args())
+
+
 @bp.route('/users/<id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
     if str(id)[0].isnumeric() is True:
-        return jsonify(User.query.get_or_404(int(id)).to_dict())
+        user = users_query(User.query).get_or_404(int(id))
+        return jsonify(user.to_dict(**user_args()))
     else:
-        ids = id[1:]
-        id_list = ids.split('A')
-        id_list = list(dict.fromkeys(id_list))
-        ids = [User.query.get_or_404(int(ident)).to_dict() for ident in id_list]
-        return jsonify(ids)
-            
+        return jsonify(users_by_ids(id[1:].split('A')))
+
 
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 def get_users():
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 100, type=int), 100)
-    data = User.to_collection_dict(User.query, page, per_page, 'api.get_users')
+    if 'ids' in request.args:
+        return jsonify({'items': users_by_ids(request.args['ids'].split(','))})
+    data = users_page(User.query, 'api.get_users')
     return jsonify(data)
 
+
+def users_by_ids(ids):
+    """
+    Loads the users with ids in one IN query and serializes them with
+    batched counts, in the order asked for. An id without a user gets
+    an error item instead of failing the whole call.
+    """
+    try:
+        ids = list(dict.fromkeys(int(ident) for ident in ids if ident))
+    except ValueError:
+        abort(bad_request('ids must be a comma separated list of user ids.'))
+    if len(ids) > MAX_IDS:
+        abort(bad_request(f'At most {MAX_IDS} ids can be requested at once.'))
+    users = users_query(User.query).filter(User.id.in_(ids)).all() if ids else []
+    found = dict(zip((user.id for user in users),
+                     User.items_to_dicts(users, user_args())))
+    return [found.get(ident, {'id': ident, 'error': 'Not Found'}) for ident in ids]
+
 @bp.route('/users/<int:id>/followers', methods=['GET'])
 @token_auth.login_required
 def get_followers(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 100, type=int), 100)
-    data = User.to_collection_dict(user.followers, page, per_page,
-                                   'api.get_followers', id=id)
+    data = users_page(user.followers, 'api.get_followers', id=id)
     return jsonify(data)
 
 @bp.route('/users/<int:id>/followed', methods=['GET'])
 @token_auth.login_required
 def get_followed(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 100, type=int), 100)
-    data = User.to_collection_dict(user.followed, page, per_page,
-                                   'api.get_followed', id=id)
+    data = users_page(user.followed, 'api.get_followed', id=id)
     return jsonify(data)
 
+@bp.route('/users/<int:id>/completion', methods=['GET'])
+@token_auth.login_required
+def get_completion(id):
+    """Returns a user's daily task completion from ?from= to ?to= (dd-mm-YYYY)."""
+    user = User.query.get_or_404(id)
+    try:
+        start = datetime.strptime(request.args['from'], "%d-%m-%Y")
+        end = datetime.strptime(request.args['to'], "%d-%m-%Y")
+    except (KeyError, ValueError):
+        return bad_request('from and to must be dates in the format dd-mm-YYYY.')
+    if end < start:
+        return bad_request('from must not be later than to.')
+    if (end - start).days >= MAX_RANGE_DAYS:
+        return bad_request(f'The range must be shorter than {MAX_RANGE_DAYS} days.')
+    result = summarise(user.completion_counts(start, end))
+    return jsonify({
+        'period_percentage': result.period_percentage,
+        'days': [{
+            'date': datetime.strftime(day.date, "%d-%m-%Y"),
+            'due': day.due,
+            'done': day.done,
+            'percentage': day.percentage
+        } for day in result.days]
+    })
+
 @bp.route('/users/<int:id>/penders', methods=['GET'])
 @token_auth.login_required
 def get_penders(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    per_page = min(request.args.get('per_page', 100, type=int), 100)
-    data = User.to_collection_dict(user.pended, page, per_page,
-                                   'api.get_penders', id=id)
+    data = users_page(user.pended, 'api.get_penders', id=id)
     return jsonify(data)
 
 
@@ -91,4 +176,23 @@ def update_user(id):
         return bad_request('please use a different email address')
     user.from_dict(data, new_user=False)
     db.session.commit()
-    return jsonify(user.to_dict())
\ No newline at end of file
+    return jsonify(user.to_dict(**user_args()))
+
+
+@bp.route('/users/<int:id>/image/<digest>', methods=['GET'])
+def get_user_image(id, digest):
+    """
+    Serves a profile picture. The URL carries the picture's content
+    hash, so responses are cached for good and a stale hash redirects
+    to the current picture. Not token protected, like the static files
+    the web pages show pictures from.
+    """
+    user = User.query.get_or_404(id)
+    current = image_digest(user.image_file)
+    if digest != current:
+        return redirect(url_for('api.get_user_image', id=id, digest=current))
+    response = send_file(image_path(user.image_file), add_etags=False,
+                         conditional=False)
+    response.set_etag(current)
+    response.headers['Cache-Control'] = IMAGE_CACHE_CONTROL
+    return response.make_conditional(request)
\ No newline at end of file
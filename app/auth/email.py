@@ -6,7 +6,8 @@ from app.email import send_email
 def send_password_reset_email(user):
     """
 
-    Sends an email containing a link to reset the users password.
+    Sends an email containing a link to reset the users password,
+    once the caller commits.
     user: should be the user object of the requester
     send-email: see app/email
     """
@@ -77,6 +77,7 @@ def reset_password_request():
         and User.query.filter_by(email=form.email.data).first()
     ):
         send_password_reset_email(User.query.filter_by(email=form.email.data).first())
+        db.session.commit()
         flash(
             f"Check your email for the instructions to reset your password", "warning"
         )
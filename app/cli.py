@@ -0,0 +1,120 @@
+import sys
+
+import click
+
+from app import db
+from app.depression import check_all_users
+from app.models import User
+from app.outbox import run_worker
+from app.scheduler import ReminderScheduler
+
+
+def register(app):
+    """Registers the arhat command line commands on app."""
+
+    @app.cli.group()
+    def occurrences():
+        """Task occurrence index commands."""
+        pass
+
+    @occurrences.command("rebuild")
+    @click.option("--user-id", type=int, help="Only rebuild this user.")
+    def rebuild_occurrences(user_id):
+        """Rebuild (or backfill) the task occurrence index."""
+        idents = user_ids(user_id)
+        for ident in idents:
+            User.query.get(ident).rebuild_occurrences()
+            db.session.commit()
+        click.echo(f"Rebuilt task occurrences for {len(idents)} users.")
+
+    @app.cli.group()
+    def series():
+        """Repeating task series commands."""
+        pass
+
+    @series.command("compact")
+    @click.option("--user-id", type=int, help="Only compact this user's series.")
+    def compact_series(user_id):
+        """Convert time limited series stored per occurrence into rules."""
+        compacted = 0
+        for ident in user_ids(user_id):
+            compacted += User.query.get(ident).compact_series()
+            db.session.commit()
+        click.echo(f"Compacted {compacted} series.")
+
+    @app.cli.group()
+    def depression():
+        """Depression check commands."""
+        pass
+
+    @depression.command("check")
+    @click.option("--processes", default=1, help="Number of worker processes.")
+    def check_depression(processes):
+        """Run today's depression check for every eligible user."""
+        checked = check_all_users(processes)
+        click.echo(f"Checked {len(checked)} users.")
+
+    @app.cli.group()
+    def reminders():
+        """Task reminder scheduler commands."""
+        pass
+
+    @reminders.command("run")
+    @click.option("--poll", default=30, help="Seconds between checks for changed tasks.")
+    def run_reminders(poll):
+        """
+        Send a push notification as each task ends.
+
+        Deploy one of these next to the web app and set
+        REMINDER_SCHEDULER = True, browsers then stop polling /check.
+        """
+        if not app.config.get("REMINDER_SCHEDULER"):
+            click.echo("REMINDER_SCHEDULER is not set, browsers still poll /check.")
+        ReminderScheduler(app, poll=poll).run()
+
+    @app.cli.command("outbox-worker")
+    @click.option("--batch-size", type=int, help="Rows claimed at a time.")
+    @click.option("--poll", default=1.0, help="Seconds to wait when the outbox is empty.")
+    @click.option("--once", is_flag=True, help="Exit once the outbox is empty.")
+    def outbox_worker(batch_size, poll, once):
+        """Deliver the emails and push notifications in the outbox."""
+        handled = run_worker(app, batch_size, poll, once)
+        click.echo(f"Delivered {handled} outbox rows.")
+
+    @app.cli.group()
+    def completion():
+        """Daily completion rollup commands."""
+        pass
+
+    @completion.command("rebuild")
+    @click.option("--user-id", type=int, help="Only rebuild this user.")
+    def rebuild_completion(user_id):
+        """Rebuild the daily completion rollup from the tasks."""
+        idents = user_ids(user_id)
+        for ident in idents:
+            User.query.get(ident).rebuild_completion()
+            db.session.commit()
+        click.echo(f"Rebuilt daily completion for {len(idents)} users.")
+
+    @completion.command("check")
+    @click.option("--user-id", type=int, help="Only check this user.")
+    def check_completion(user_id):
+        """Compare the daily completion rollup with a full recount."""
+        mismatched = 0
+        for ident in user_ids(user_id):
+            for day, stored, actual in User.query.get(ident).completion_mismatches():
+                mismatched += 1
+                click.echo(
+                    f"user {ident} {day:%d-%m-%Y}: rollup {stored[0]} due "
+                    f"{stored[1]} done, recount {actual[0]} due {actual[1]} done"
+                )
+        click.echo(f"{mismatched} mismatched days.")
+        if mismatched:
+            sys.exit(1)
+
+
+def user_ids(user_id=None):
+    """Returns [user_id] or, without it, the ids of all users."""
+    if user_id:
+        return [user_id]
+    return [ident for (ident,) in db.session.query(User.id)]
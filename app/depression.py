@@ -0,0 +1,130 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+from flask import current_app
+from sqlalchemy import or_
+
+from app import create_app, db
+from app.models import User
+
+
+DayCompletion = namedtuple("DayCompletion", ["date", "due", "done", "percentage"])
+
+
+class DepressionResult(namedtuple("DepressionResult", ["period_percentage", "days"])):
+    """
+    Outcome of a depression check.
+
+    period_percentage: the average daily percentage of due tasks that were
+        done, 100 if no tasks were due during the period
+    days: a DayCompletion per checked day, oldest first
+    """
+
+    def below(self, threshold):
+        """Checks the period percentage against a user set threshold."""
+        return self.period_percentage < threshold
+
+
+def summarise(counts):
+    """Turns daily [due, done] counts into a DepressionResult."""
+    days = []
+    for day in sorted(counts):
+        due, done = counts[day]
+        percentage = done / due * 100 if due else None
+        days.append(DayCompletion(day, due, done, percentage))
+    percentages = [day.percentage for day in days if day.percentage is not None]
+    if percentages:
+        period_percentage = sum(percentages) / len(percentages)
+    else:
+        period_percentage = 100
+    return DepressionResult(period_percentage, days)
+
+
+def run_depression_check(user, today=None):
+    """
+    Calculates the percentage of due tasks a user completed over the
+    user set number of days before today.
+
+    Days without any due tasks are left out of the average.
+    The counts are read from the daily completion rollup, which is
+    caught up to yesterday first.
+    """
+    if today is None:
+        today = datetime.utcnow().date()
+    end = datetime.combine(today, datetime.min.time()) - timedelta(days=1)
+    start = end - timedelta(days=(user.days or 0) - 1)
+    if start > end:
+        return summarise({})
+    user.catch_up_completion(end)
+    return summarise(user.completion_counts(start, end))
+
+
+def eligible_user_ids(today):
+    """
+    Returns the ids of users with a threshold and days set
+    who have not been checked on today (a "%Y-%m-%d %H:%M:%S" string).
+    """
+    query = db.session.query(User.id).filter(
+        User.threshold > 0,
+        User.days > 0,
+        or_(User.sent_date == None, User.sent_date != today),
+    )
+    return [ident for (ident,) in query.order_by(User.id)]
+
+
+def check_users(user_ids):
+    """
+    Runs the depression check for each user id.
+
+    Returns the ids that were checked, a failing user is logged
+    and left to be retried on the next run.
+    """
+    checked = []
+    for ident in user_ids:
+        try:
+            User.query.get(ident).check_depression()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            current_app.logger.exception(f"Depression check failed for user {ident}")
+        else:
+            checked.append(ident)
+    return checked
+
+
+def init_worker(config):
+    """
+    Gives each pool process its own app, with the parent app's config,
+    app context and database connections. The session inherited from
+    the parent is dropped unused, its connection belongs to the parent.
+    """
+    db.session.registry.clear()
+    create_app(type("PoolConfig", (object,), config)).app_context().push()
+
+
+def check_all_users(processes=1, today=None):
+    """
+    Runs the daily depression check for every eligible user.
+
+    Users are sharded across a pool of processes, then sent_date
+    is recorded for all checked users in one update.
+    """
+    if today is None:
+        today = datetime.utcnow().date()
+    sent_date = datetime.strftime(today, "%Y-%m-%d %H:%M:%S")
+    user_ids = eligible_user_ids(sent_date)
+    if processes > 1 and len(user_ids) > 1:
+        shards = [user_ids[shard::processes] for shard in range(processes)]
+        with Pool(
+            processes, initializer=init_worker, initargs=(dict(current_app.config),)
+        ) as pool:
+            checked = [ident for shard in pool.map(check_users, shards) for ident in shard]
+    else:
+        checked = check_users(user_ids)
+    if checked:
+        User.query.filter(User.id.in_(checked)).update(
+            {User.sent_date: sent_date}, synchronize_session=False
+        )
+        db.session.commit()
+    return checked
@@ -1,23 +1,147 @@
-from threading import Thread
+import atexit
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
 
 from flask_mail import Message
 
-from flask import current_app
-
 from app import mail
 
 
-def send_async_email(app, msg):
-    """Sends email outside of current_app context."""
-    with app.app_context():
-        mail.send(msg)
+class MailQueue(object):
+    """
+    Delivers email from a bounded queue drained by a fixed pool of
+    worker threads, instead of a thread and SMTP connection per email.
+
+    Each worker sends whatever is waiting, up to MAIL_BATCH_SIZE
+    emails, over one SMTP connection. When the queue is full, senders
+    wait up to MAIL_QUEUE_TIMEOUT seconds for room. Pending email is
+    drained on shutdown.
+
+    Configured with MAIL_WORKERS (default 2), MAIL_QUEUE_SIZE (100),
+    MAIL_QUEUE_TIMEOUT (5) and MAIL_BATCH_SIZE (20).
+    """
+
+    def __init__(self, app=None):
+        self.queue = None
+        self.workers = []
+        self.lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("MAIL_WORKERS", 2)
+        app.config.setdefault("MAIL_QUEUE_SIZE", 100)
+        app.config.setdefault("MAIL_QUEUE_TIMEOUT", 5)
+        app.config.setdefault("MAIL_BATCH_SIZE", 20)
+        app.extensions["mail_queue"] = self
+
+    def send(self, app, msg, done=None):
+        """
+        Queues msg, waiting for room if the queue is full.
+
+        done: called with msg and None once sent, or the error message.
+        Returns False if there was still no room after MAIL_QUEUE_TIMEOUT.
+        """
+        self.start(app)
+        try:
+            self.queue.put((app, msg, done), timeout=app.config["MAIL_QUEUE_TIMEOUT"])
+        except Full:
+            app.logger.error(f"Mail queue full, email to {msg.recipients} dropped")
+            return False
+        return True
+
+    def start(self, app):
+        """Starts the worker threads on first use."""
+        with self.lock:
+            if self.queue is None:
+                self.queue = Queue(app.config["MAIL_QUEUE_SIZE"])
+                atexit.register(self.shutdown)
+            while len(self.workers) < app.config["MAIL_WORKERS"]:
+                worker = Thread(
+                    target=self.work, args=(app.config["MAIL_BATCH_SIZE"],), daemon=True
+                )
+                worker.start()
+                self.workers.append(worker)
+
+    def shutdown(self):
+        """Stops the workers once every queued email has been sent."""
+        with self.lock:
+            workers, self.workers = self.workers, []
+            for _ in workers:
+                self.queue.put(None)
+        for worker in workers:
+            worker.join()
+
+    def work(self, batch_size):
+        """Worker thread loop, a None job stops the worker."""
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while batch[-1] is not None and len(batch) < batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            if batch[-1] is None:
+                running = False
+            jobs = [job for job in batch if job is not None]
+            try:
+                if jobs:
+                    deliver(jobs)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+def deliver(jobs):
+    """Sends the queued (app, message, done) jobs over one SMTP connection per app."""
+    apps = []
+    for app, msg, done in jobs:
+        if app not in apps:
+            apps.append(app)
+    for app in apps:
+        batch = [(msg, done) for job_app, msg, done in jobs if job_app is app]
+        results = {}
+        with app.app_context():
+            try:
+                with mail.connect() as conn:
+                    for msg, done in batch:
+                        try:
+                            conn.send(msg)
+                        except Exception as error:
+                            app.logger.exception(f"Email to {msg.recipients} failed")
+                            results[id(msg)] = str(error)
+                        else:
+                            results[id(msg)] = None
+            except Exception as error:
+                app.logger.exception(f"Could not connect to send {len(batch)} emails")
+                for msg, done in batch:
+                    results.setdefault(id(msg), str(error))
+        for msg, done in batch:
+            if done is not None:
+                done(msg, results[id(msg)])
+
+
+mail_queue = MailQueue()
+
+
+def send_email(subject, sender, recipients, text_body, html_body, key=None):
+    """
+    Adds an email to the outbox, it is sent once the caller commits.
+
+    key: optional idempotency key, see Outbox.add
+    """
+    from app.models import Outbox
+
+    return Outbox.email(subject, sender, recipients, text_body, html_body, key=key)
 
 
-def send_email(subject, sender, recipients, text_body, html_body):
-    """Sends threaded email."""
-    msg = Message(subject, sender=sender, recipients=recipients)
-    msg.body = text_body
-    msg.html = html_body
-    Thread(
-        target=send_async_email, args=(current_app._get_current_object(), msg)
-    ).start()
+def outbox_message(payload, ident):
+    """Builds the Message for an outbox email payload."""
+    msg = Message(
+        payload["subject"], sender=payload["sender"], recipients=payload["recipients"]
+    )
+    msg.body = payload["text_body"]
+    msg.html = payload["html_body"]
+    msg.msgId = f"<outbox-{ident}@arhat>"
+    return msg
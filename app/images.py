@@ -0,0 +1,65 @@
+import base64
+import hashlib
+import os
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+
+import simplejson as json
+from flask import current_app
+
+
+PROFILE_PICS = "static/profile_pics"
+
+
+def image_path(image_file):
+    """Returns the path of a profile picture on disk."""
+    return os.path.join(current_app.root_path, PROFILE_PICS, image_file)
+
+
+@lru_cache(maxsize=4096)
+def file_digest(path, mtime, size):
+    """Hashes a file, cached until it is modified."""
+    with open(path, "rb") as img_file:
+        return hashlib.sha256(img_file.read()).hexdigest()[:16]
+
+
+def image_digest(image_file):
+    """
+    Returns a short content hash of a profile picture, used in its URL
+    and as its ETag so the URL changes whenever the picture does.
+    """
+    path = image_path(image_file)
+    stat = os.stat(path)
+    return file_digest(path, stat.st_mtime_ns, stat.st_size)
+
+
+class ImageCache(object):
+    """
+    An LRU of base64 encoded profile pictures, for clients that opt in
+    to inline images. Keyed by path and content hash, so a replaced
+    picture is encoded again. Holds INLINE_IMAGE_CACHE_SIZE (default
+    128) images.
+    """
+
+    def __init__(self):
+        self.images = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, image_file):
+        """Returns a profile picture as a JSON encoded base64 string."""
+        key = (image_path(image_file), image_digest(image_file))
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                return self.images[key]
+        with open(key[0], "rb") as img_file:
+            encoded = json.dumps(base64.b64encode(img_file.read()))
+        with self.lock:
+            self.images[key] = encoded
+            while len(self.images) > current_app.config.get("INLINE_IMAGE_CACHE_SIZE", 128):
+                self.images.popitem(last=False)
+        return encoded
+
+
+image_cache = ImageCache()
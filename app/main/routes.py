@@ -1,4 +1,3 @@
-import json
 from datetime import datetime
 
 from flask import (
@@ -12,12 +11,11 @@ from flask import (
     url_for,
 )
 from flask_login import current_user, login_required
-from pywebpush import webpush
 
 from app import db
 from app.main import bp
 from app.main.forms import DateForm, TaskForm
-from app.models import Post, User
+from app.models import Outbox, Post
 
 
 @bp.route("/", methods=["GET", "POST"])
@@ -47,20 +45,8 @@ def index(date_set):
     today = False
     if convert_date_format(datetime.utcnow()) == date:
         today = True
-    current_user.check_if_depression_sent(date)
     date_form.datepicker.data = date
-    all_frequency_tasks = current_user.posts.filter(Post.frequency != None).all()
-    todos = current_user.posts.filter_by(date=date)
-    exclusions = [todo.exclude for todo in todos if todo.exclude]
-    frequency_tasks = [
-        task
-        for task in all_frequency_tasks
-        if task.frequency > 0
-        and (date - task.date).days > 0
-        and ((date - task.date).days % task.frequency) == 0
-        and task.date < date
-        and task.id not in exclusions
-    ]
+    todos, frequency_tasks = current_user.tasks_for_date(date)
     return render_template(
         "index.html",
         frequency_tasks=frequency_tasks,
@@ -91,6 +77,9 @@ def new_task():
             new_task.date = new_task.string_to_datetime(new_task.form.date.data)
             if new_task.to_date > new_task.date:
                 new_task.add_multiple_tasks()
+                current_user.sync_occurrences(new_task.task_to_be_added)
+                current_user.refresh_completion(new_task.date)
+                db.session.commit()
                 flash("Your tasks are now live!", "success")
             else:
                 return redirect(url_for("main.index", date_set="ph"))
@@ -102,6 +91,9 @@ def new_task():
             db.session.add(task_to_be_added)
             new_task.commit_flush()
             new_task.ident = task_to_be_added.id
+            current_user.sync_occurrences(task_to_be_added)
+            current_user.refresh_completion(task_to_be_added.date)
+            db.session.commit()
             flash("Your task is now live!", "success")
         else:
             return redirect(url_for("main.index", date_set="ph"))
@@ -135,6 +127,8 @@ def edit_task():
         return redirect(url_for("main.index", date_set="ph"))
     else:
         edit_task.calc_mins_height_and_end()
+        refresh_from = current_user.series_start(edit_task.task_to_be_edited)
+        edited_days = [edit_task.task_to_be_edited.date]
         if edit_task.form.single_event.data is True:
             if (
                 edit_task.task_to_be_edited.exclude
@@ -144,11 +138,19 @@ def edit_task():
                 edit_task.edit_single_task()
             else:
                 edit_task.edit_single_freq_task()
+                edited_days.append(edit_task.task_to_be_added.date)
         else:
             if edit_task.task_to_be_edited.exclude:
                 edit_task.edit_all_freq_parent_and_child_tasks()
             else:
                 edit_task.edit_all_tasks()
+        current_user.sync_occurrences(edit_task.task_to_be_edited)
+        if edit_task.form.single_event.data is True:
+            current_user.refresh_completion_days(*edited_days)
+        else:
+            current_user.refresh_completion(
+                min(refresh_from, edit_task.task_to_be_edited.date)
+            )
         db.session.commit()
         return jsonify({"id": edit_task.form.ident.data})
 
@@ -164,6 +166,7 @@ def update_task():
         top = "".join([n for n in data["top"] if n.isnumeric()])
         task.start_time = int(top)
         task.end_time = int(height) + int(top)
+        task.author.tasks_changed = datetime.utcnow()
         db.session.commit()
     return jsonify({"task": task.body})
 
@@ -177,20 +180,35 @@ def check():
     If tasks are due a notification is triggered.
     """
 
+    task = None
     if current_user.subscribed and str(request.args.get("id")).isnumeric():
-        ident = int(request.args.get("id"))
-        task = current_user.posts.filter_by(id=ident).first()
-        webpush(
-            subscription_info=json.loads(User.query.all()[0].subscription),
-            data=f"You need to {task.body}",
-            vapid_private_key=current_app.config["VAPID_PRIVATE_KEY"],
-            vapid_claims=current_app.config["VAPID_CLAIMS"],
-        )
+        task = current_user.posts.filter_by(id=int(request.args.get("id"))).first()
+    if task:
+        ident = task.id
+        Outbox.push(current_user, f"You need to {task.body}")
+        db.session.commit()
     else:
         ident = False
     return jsonify({"id": ident})
 
 
+@bp.route("/timezone", methods=["POST"])
+@login_required
+def timezone():
+    """
+    Stores the minutes the user's browser clock is ahead of UTC,
+    so reminders go out at the local time each task ends.
+    """
+    offset = (request.get_json(silent=True) or {}).get("offset")
+    if not isinstance(offset, int) or not -12 * 60 <= offset <= 14 * 60:
+        return jsonify({"error": "offset must be minutes ahead of UTC"}), 400
+    if current_user.utc_offset != offset:
+        current_user.utc_offset = offset
+        current_user.tasks_changed = datetime.utcnow()
+        db.session.commit()
+    return jsonify({"offset": offset})
+
+
 @bp.route("/complete", methods=["GET", "POST"])
 @login_required
 def complete():
@@ -198,8 +216,12 @@ def complete():
     if request.args:
         if request.args.get("id").isnumeric():
             ident = int(request.args.get("id"))
-            task = current_user.posts.filter_by(id=ident)
-            task[0].done = True
+            task = current_user.posts.filter_by(id=ident)[0].complete_occurrence(
+                current_user.local_date()
+            )
+            db.session.flush()
+            current_user.sync_occurrences(task)
+            current_user.refresh_completion_days(task.date)
             db.session.commit()
     return redirect(url_for("main.index", date_set="ph"))
 
@@ -1,38 +1,60 @@
 import os
+import hashlib
 import secrets
 import base64
 from datetime import datetime, timedelta
+from functools import partial
+from itertools import groupby
+from operator import attrgetter
 from time import time
 import simplejson as json
 import jwt
 from flask import current_app, flash, url_for
 from flask_login import UserMixin, current_user
 from PIL import Image
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import check_password_hash, generate_password_hash
 
 from app import db, login
 from app.email import send_email
+from app.images import image_cache, image_digest
+from app.pagination import keyset_paginate
+from app.recurrence import day_offset, expand_series, occurrence_dates
+from app.token_cache import deny_list, token_cache
 
 followers = db.Table(
     "followers",
     db.Column("follower_id", db.Integer, db.ForeignKey("user.id")),
     db.Column("followed_id", db.Integer, db.ForeignKey("user.id")),
+    db.Index("ix_followers_follower_id_followed_id", "follower_id", "followed_id"),
+    db.Index("ix_followers_followed_id_follower_id", "followed_id", "follower_id"),
 )
 
 penders = db.Table(
     "penders",
     db.Column("pender_id", db.Integer, db.ForeignKey("user.id")),
     db.Column("pendered_id", db.Integer, db.ForeignKey("user.id")),
+    db.Index("ix_penders_pender_id_pendered_id", "pender_id", "pendered_id"),
+    db.Index("ix_penders_pendered_id_pender_id", "pendered_id", "pender_id"),
 )
 
 
+def api_dict(getters, fields):
+    """Builds an API representation from the getters named in fields."""
+    return {name: getter() for name, getter in getters.items() if name in fields}
+
+
 class PaginatedAPIMixin(object):
     @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+    def to_collection_dict(query, page, per_page, endpoint, item_args=None,
+                           **kwargs):
+        item_args = item_args or {}
         if page is not None:
             resources = query.paginate(page, per_page, False)
             data = {
-                    'items': [item.to_dict() for item in resources.items],
+                    'items': PaginatedAPIMixin.items_to_dicts(resources.items,
+                                                              item_args),
                     '_meta': {
                         'page': page,
                         'per_page': per_page,
@@ -50,10 +72,57 @@ class PaginatedAPIMixin(object):
                 }      
         else:
             data = {
-                'items': [item.to_dict() for item in query]
+                'items': PaginatedAPIMixin.items_to_dicts(list(query), item_args)
             }
         return data
 
+    @staticmethod
+    def to_cursor_dict(query, keys, per_page, cursor, endpoint, descending=False,
+                       item_args=None, **kwargs):
+        """
+        Like to_collection_dict, but reads the page after cursor ordered by
+        keys, see keyset_paginate, and links to the next and previous pages
+        with opaque cursors.
+        """
+        resources = keyset_paginate(query, keys, per_page, cursor, descending)
+        return {
+            'items': PaginatedAPIMixin.items_to_dicts(resources.items,
+                                                      item_args or {}),
+            '_meta': {
+                'per_page': per_page,
+                'cursor': cursor
+            },
+            '_links': {
+                'self': url_for(endpoint, cursor=cursor, per_page=per_page,
+                                **kwargs),
+                'next': url_for(endpoint, cursor=resources.next_cursor,
+                                per_page=per_page, **kwargs)
+                        if resources.next_cursor else None,
+                'prev': url_for(endpoint, cursor=resources.prev_cursor,
+                                per_page=per_page, **kwargs)
+                        if resources.prev_cursor else None
+            }
+        }
+
+    @staticmethod
+    def items_to_dicts(items, item_args):
+        """
+        Serializes items, passing each to_dict the values its class
+        prefetched for the whole list, see prefetch.
+        """
+        prefetch = getattr(type(items[0]), 'prefetch', None) if items else None
+        prefetched = prefetch(items, **item_args) if prefetch else {}
+        return [item.to_dict(**item_args, **prefetched.get(item.id, {}))
+                for item in items]
+
+    @staticmethod
+    def prefetch(items, **item_args):
+        """
+        Returns to_dict keyword arguments keyed by item id, loaded for
+        a whole page at once instead of by each item.
+        """
+        return {}
+
 
 class User(PaginatedAPIMixin, UserMixin, db.Model):
     """
@@ -62,7 +131,9 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     password_hash: hashed password
     posts: These are the user tasks
     last_seen: The date and time the user last logged in TODO delete
-    subscription: The notificaiton subscription dictionary
+    subscription: The notificaiton subscription dictionary TODO delete,
+        replaced by push_subscriptions
+    push_subscriptions: The notification subscriptions of the user's devices
     subscribed: local record of whether a user wants notifications or not
     sent_date: The date that depression notifcations were last sent
     threshold: The percentage of incomplete tasks that will 
@@ -72,6 +143,13 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     followed: Other users that are followed by user
     pended: Users who have not confirmed follow request
     last_message_read_time: The last time a message was read by the user  
+    occurrences_from: The first date covered by the user's task occurrences
+    occurrences_to: The last date covered by the user's task occurrences
+    completion_to: The last date covered by the user's daily completion rollup
+    tasks_changed: When the user's tasks were last created or edited,
+        used by the reminder scheduler to reload them
+    utc_offset: Minutes the user's clock is ahead of UTC, reported by
+        their browser, task times are local wall clock minutes
     """
 
     id = db.Column(db.Integer, primary_key=True)
@@ -83,6 +161,9 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
     subscription = db.Column(db.String(1000), nullable=True)
     subscribed = db.Column(db.Boolean, default=False)
+    push_subscriptions = db.relationship(
+        "PushSubscription", backref="user", lazy="dynamic"
+    )
     sent_date = db.Column(db.String(120), nullable=True)
     threshold = db.Column(db.Integer, nullable=True)
     days = db.Column(db.Integer, nullable=True)
@@ -104,6 +185,11 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     )
     token = db.Column(db.String(32), index=True, unique=True)
     token_expiration = db.Column(db.DateTime)
+    occurrences_from = db.Column(db.DateTime, nullable=True)
+    occurrences_to = db.Column(db.DateTime, nullable=True)
+    completion_to = db.Column(db.DateTime, nullable=True)
+    tasks_changed = db.Column(db.DateTime, index=True, nullable=True)
+    utc_offset = db.Column(db.Integer, nullable=True, default=0)
 
     def __repr__(self):
         """returns a formatted user object."""
@@ -239,90 +325,199 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         i.save(picture_path)
         self.image_file = picture_fn
 
-    def check_freq_tasks_in_days(self):
+    def count_completion(self, start, end):
         """
-        Finds all frequency tasks that occur in 
-        the user set depression check day range.
-        
+        Counts due and done tasks for every date from start to end.
+
+        Returns a dict of date to [due, done]. Tasks set on each date
+        are counted with one grouped query, then the frequency tasks
+        are expanded in a single pass. Occurrences replaced by an
+        edited task are not counted twice.
         """
-        for self.freq_task in self.outstanding_frequency_tasks:
-            if (
-                self.freq_task.frequency != 0
-                and (
-                    self.date_for_depress_check(self.date_set) - self.freq_task.date
-                ).days
-                > 0
-                and (
-                    self.date_for_depress_check(self.date_set) - self.freq_task.date
-                ).days
-                % self.freq_task.frequency
-                == 0
-            ):
-                self.freq_daily_tasks += 1
-                self.check_for_edited_freqs()
+        counts = {
+            start + timedelta(days=offset): [0, 0]
+            for offset in range((end - start).days + 1)
+        }
+        exclusions = set()
+        rows = (
+            db.session.query(
+                Post.date,
+                Post.exclude,
+                db.func.count(Post.id),
+                db.func.sum(db.case([(Post.done == True, 1)], else_=0)),
+            )
+            .filter(Post.user_id == self.id, Post.date >= start, Post.date <= end)
+            .group_by(Post.date, Post.exclude)
+        )
+        for day, exclude, due, done in rows:
+            if day not in counts:
+                continue
+            counts[day][0] += due
+            counts[day][1] += done or 0
+            if exclude:
+                exclusions.add((exclude, day))
+        series = self.posts.filter(
+            Post.frequency > 0, Post.date < end, Post.to_date_after(start)
+        ).all()
+        for day, task in expand_series(series, exclusions, start, end):
+            counts[day][0] += 1
+        return counts
+
+    def completion_counts(self, start, end):
+        """
+        Reads due and done task counts from start to end out of the
+        daily completion rollup. Dates the rollup does not cover yet
+        are counted from the tasks, nothing is written.
 
-    def check_for_edited_freqs(self):
+        Returns a dict of date to [due, done].
         """
-        Removes any edited frequency tasks from the depression check
-        (These will be picked up by subsequent check of all individual tasks)
+        counts = {
+            start + timedelta(days=offset): [0, 0]
+            for offset in range((end - start).days + 1)
+        }
+        covered_to = min(end, self.completion_to or start - timedelta(days=1))
+        rows = DailyCompletion.query.filter(
+            DailyCompletion.user_id == self.id,
+            DailyCompletion.date >= start,
+            DailyCompletion.date <= covered_to,
+        )
+        for row in rows:
+            counts[row.date] = [row.due_count, row.done_count]
+        if covered_to < end:
+            counts.update(
+                self.count_completion(max(start, covered_to + timedelta(days=1)), end)
+            )
+        return counts
+
+    def catch_up_completion(self, end):
+        """Extends the daily completion rollup to end, building it first if needed."""
+        if self.completion_to is None:
+            self.rebuild_completion()
+        if end > self.completion_to:
+            self.refresh_completion(self.completion_to + timedelta(days=1), end)
+
+    def refresh_completion(self, start, end=None):
         """
-        for self.tsk in self.daily_tasks:
-            if self.tsk.exclude == self.freq_task.id:
-                self.freq_daily_tasks -= 1
+        Recounts the daily completion rollup from start to end.
 
-    def check_tasks_in_days(self):
+        end defaults to the last date the rollup covers. Nothing is
+        done until the rollup has been built for the user.
+        """
+        if self.completion_to is None:
+            return
+        start = datetime.combine(start.date(), datetime.min.time())
+        end = end or self.completion_to
+        if start > end:
+            return
+        DailyCompletion.query.filter(
+            DailyCompletion.user_id == self.id,
+            DailyCompletion.date >= start,
+            DailyCompletion.date <= end,
+        ).delete(synchronize_session=False)
+        self.add_completion(self.count_completion(start, end))
+        self.completion_to = max(self.completion_to, end)
+
+    def refresh_completion_days(self, *days):
+        """
+        Recounts the daily completion rollup on just the given dates,
+        for changes that only affect the days of single tasks. Dates
+        after the rollup are left to be counted when it catches up.
+        """
+        if self.completion_to is None:
+            return
+        for day in sorted({day.date() for day in days if day is not None}):
+            day = datetime.combine(day, datetime.min.time())
+            if day <= self.completion_to:
+                self.refresh_completion(day, day)
+
+    def rebuild_completion(self, today=None):
+        """Rebuilds the user's daily completion rollup up to today."""
+        if today is None:
+            today = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+        DailyCompletion.query.filter_by(user_id=self.id).delete()
+        first = db.session.query(db.func.min(Post.date)).filter(
+            Post.user_id == self.id
+        ).scalar()
+        if first is not None and first <= today:
+            start = datetime.combine(first.date(), datetime.min.time())
+            self.add_completion(self.count_completion(start, today))
+        self.completion_to = today
+
+    def compact_series(self):
         """
-        Sets up for loop and variables for checking through tasks
-        that occured during depression check day range.
+        Converts the user's time limited series stored as one task per
+        occurrence into rules (see Post.compact_series), then rebuilds
+        the task occurrences and daily completion rollup.
 
+        Returns the number of series compacted.
         """
-        for self.day in range(self.days):
-            self.date_set = self.date_set - timedelta(days=1)
-            self.daily_tasks = self.posts.filter_by(
-                date=self.date_for_depress_check(self.date_set)
-            )
-            self.done_tasks = 0
-            self.freq_daily_tasks = 0
-            self.freq_done_tasks = 0
-            self.check_freq_tasks_in_days()
-            self.check_tasks_over_0()
-
-    def check_if_task_done(self):
-        """Checks if task is done and totals these."""
-        for self.task in self.daily_tasks:
-            if self.task.done == True:
-                self.done_tasks += 1
-
-    def check_tasks_over_0(self):
-        """
-        If tasks occured on the day in question
-        calculates daily depression percentage 
-        (done tasks divided by tasks due)
-        Adds this value to a running total and increments 
-        the number of days to divide by.
-
-        """
-        if self.daily_tasks.count() > 0:
-            self.check_if_task_done()
-            self.daily_percentage = (
-                self.done_tasks / self.daily_tasks.count() + self.freq_daily_tasks
-            ) * 100
-            self.divide_days += 1
-            self.period_precentage += self.daily_percentage
-        elif self.freq_daily_tasks > 0:
-            self.divide_days += 1
-
-    def check_divide_days_over_0(self):
-        """
-        Checks that divide days is over 0,
-        anything under signifies that no tasks 
-        were set during the depression check date range.
-
-        """
-        if self.divide_days > 0:
-            self.period_precentage /= self.divide_days
-        else:
-            self.period_precentage = 100
+        tasks = self.posts.filter(Post.exclude != None, Post.to_date != None).order_by(
+            Post.exclude, Post.date, Post.id
+        )
+        compacted = sum(
+            Post.compact_series(list(series))
+            for _, series in groupby(tasks, key=attrgetter("exclude"))
+        )
+        if compacted:
+            db.session.flush()
+            self.rebuild_occurrences()
+            if self.completion_to is not None:
+                self.rebuild_completion()
+        return compacted
+
+    def add_completion(self, counts):
+        """Bulk inserts the non empty days of counts into the rollup."""
+        db.session.bulk_insert_mappings(
+            DailyCompletion,
+            [
+                {
+                    "user_id": self.id,
+                    "date": day,
+                    "due_count": due,
+                    "done_count": done,
+                }
+                for day, (due, done) in counts.items()
+                if due or done
+            ],
+        )
+
+    def completion_mismatches(self):
+        """
+        Compares the daily completion rollup with a full recount.
+
+        Returns a list of (date, rollup counts, recounted counts)
+        for every date that differs.
+        """
+        if self.completion_to is None:
+            return []
+        stored = {
+            row.date: [row.due_count, row.done_count]
+            for row in DailyCompletion.query.filter_by(user_id=self.id)
+        }
+        first = db.session.query(db.func.min(Post.date)).filter(
+            Post.user_id == self.id
+        ).scalar()
+        starts = list(stored) + ([first] if first else [])
+        if not starts:
+            return []
+        start = datetime.combine(min(starts).date(), datetime.min.time())
+        actual = {}
+        if start <= self.completion_to:
+            actual = self.count_completion(start, self.completion_to)
+        return [
+            (day, stored.get(day, [0, 0]), actual.get(day, [0, 0]))
+            for day in sorted(set(stored) | set(actual))
+            if stored.get(day, [0, 0]) != actual.get(day, [0, 0])
+        ]
+
+    def series_start(self, task):
+        """Returns the earliest date of task and the frequency task it belongs to."""
+        dates = [task.date]
+        if task.exclude and task.exclude != task.id:
+            parent = Post.query.get(task.exclude)
+            if parent:
+                dates.append(parent.date)
+        return min(dates)
 
     def check_depression(self):
         """
@@ -330,94 +525,125 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         the user set threshold. If lower then then messages and emails
         are sent to all users that the current user follows. 
         
+        Returns the emails of the users alerted.
         """
-        self.all_frequency_tasks = self.posts.filter(Post.frequency != None).all()
-        self.outstanding_frequency_tasks = [
-            task for task in self.all_frequency_tasks if task.done is False
-        ]
-        self.date_set = datetime.utcnow().date()
-        self.daily_percentage = 0
-        self.period_precentage = 0
-        self.divide_days = 0
-        self.check_tasks_in_days()
-        self.check_divide_days_over_0()
-        self.check_percentage_against_threshold()
+        from app.depression import run_depression_check
 
-    def check_percentage_against_threshold(self):
+        result = run_depression_check(self)
+        return self.check_percentage_against_threshold(result.period_percentage)
+
+    def check_percentage_against_threshold(self, percentage):
         """
         Checks that depression percentage is below the user set threshold. 
         If so, emails will be sent to followers.
+
+        The messages and the outbox emails are added in one transaction,
+        each at most once per follower and day, keyed like the emails.
+        Returns the emails of the followers alerted by this call.
         """
-        if self.period_precentage < self.threshold:
-            for followed in self.followed.all():
-                send_email(
-                    "Urgent",
-                    current_app.config["ADMINS"][0],
-                    [followed.email],
-                    f"please contact {self.username}",
-                    html_body=None,
-                )
-                msg = Message(
-                    author=self,
-                    recipient=followed,
-                    body=f"please contact {self.username}",
-                )
-                db.session.add(msg)
-                db.session.commit()
+        if not self.threshold or percentage >= self.threshold:
+            return []
+        followed = self.followed.all()
+        if not followed:
+            return []
+        body = f"please contact {self.username}"
+        today = datetime.utcnow().date()
+        alerted = [
+            user for user in followed
+            if send_email(
+                "Urgent",
+                current_app.config["ADMINS"][0],
+                [user.email],
+                body,
+                html_body=None,
+                key=f"threshold:{self.id}:{user.id}:{today}",
+            ) is not None
+        ]
+        db.session.bulk_insert_mappings(
+            Message,
+            [
+                {"sender_id": self.id, "recipient_id": user.id, "body": body}
+                for user in alerted
+            ],
+        )
+        db.session.commit()
+        return [user.email for user in alerted]
 
-    def date_for_depress_check(self, date_set):
-        """Formats short date for depression check, from string, to datetime."""
-        return datetime.strptime(str(date_set), "%Y-%m-%d")
+    def prep_image_for_json(self):
+        return image_cache.get(self.image_file)
 
-    def add_sent_date_check_depression(self, date):
-        """Triggers depression check and sets depression check date."""
-        self.check_depression()
-        self.sent_date = date
-        db.session.commit()
+    def image_url(self):
+        return url_for(
+            'api.get_user_image', id=self.id, digest=image_digest(self.image_file)
+        )
 
-    def check_if_depression_sent(self, date):
+    API_FIELDS = (
+        'id', 'image_url', 'image', 'threshold', 'days', 'email', 'username',
+        'last_seen', 'post_count', 'follower_count', 'followed_count', '_links'
+    )
+    FIELD_COLUMNS = {'image_url': ('image_file',), 'image': ('image_file',)}
+    COUNTS = {
+        'post_count': 'posts', 'follower_count': 'followers',
+        'followed_count': 'followed'
+    }
+
+    def to_dict(self, include_email=False, inline_image=False, counts=None,
+                fields=None):
         """
-        Checks that depression check has not already occured today.
-        and that a threshold and date range has been set by the user.
-
+        fields: the API_FIELDS to include, by default all but image,
+            which inline_image adds
+        counts: prefetched post and follow counts, see prefetch
         """
-        today = datetime.strftime(datetime.utcnow().date(), "%Y-%m-%d %H:%M:%S")
-        if self.sent_date:
-            if str(self.sent_date) != today:
-                self.add_sent_date_check_depression(date)
-        elif self.threshold and self.days:
-            self.add_sent_date_check_depression(today)
-
-    def prep_image_for_json(self):
-        picture_fn = os.path.join(
-            current_app.root_path, "static/profile_pics", self.image_file
-        )
-        with open(picture_fn, 'rb') as img_file:
-            img_data = base64.b64encode(img_file.read())
-        return json.dumps(img_data)
-
-
-    def to_dict(self, include_email=False):
-        data = {
-            'id': self.id,
-            'image': self.prep_image_for_json(),
-            'threshold': self.threshold,
-            'days': self.days,
-            'email': self.email,
-            'username': self.username,
-            'last_seen': self.last_seen.isoformat(),
-            'post_count': self.posts.count(),
-            'follower_count': self.followers.count(),
-            'followed_count': self.followed.count(),
-            '_links': {
+        if fields is None:
+            fields = set(self.API_FIELDS) - {'image'}
+            if inline_image:
+                fields.add('image')
+        counts = counts or {}
+        getters = {
+            'id': lambda: self.id,
+            'image_url': self.image_url,
+            'image': self.prep_image_for_json,
+            'threshold': lambda: self.threshold,
+            'days': lambda: self.days,
+            'email': lambda: self.email,
+            'username': lambda: self.username,
+            'last_seen': lambda: self.last_seen.isoformat(),
+            '_links': lambda: {
                 'self': url_for('api.get_user', id=self.id),
                 'followers': url_for('api.get_followers', id=self.id),
                 'followed': url_for('api.get_followed', id=self.id)
             }
         }
-        if include_email:
-            data['email'] = self.email
-        return data
+        for name, relationship in self.COUNTS.items():
+            getters[name] = lambda name=name, relationship=relationship: (
+                counts[name] if name in counts
+                else getattr(self, relationship).count())
+        return api_dict(getters, fields)
+
+    @staticmethod
+    def prefetch(users, fields=None, **item_args):
+        """
+        Counts the posts, followers and followed users of a page of
+        users with one grouped query each, for the counts in fields.
+        """
+        ids = [user.id for user in users]
+        counts = {ident: {} for ident in ids}
+        for name, column, query in (
+            ('post_count', Post.user_id, db.session.query(Post.user_id)),
+            ('follower_count', followers.c.followed_id,
+             db.session.query(followers.c.followed_id)),
+            ('followed_count', followers.c.follower_id,
+             db.session.query(followers.c.follower_id)),
+        ):
+            if fields is not None and name not in fields:
+                continue
+            for ident in ids:
+                counts[ident][name] = 0
+            grouped = query.add_columns(db.func.count()).filter(
+                column.in_(ids)).group_by(column)
+            for ident, count in grouped:
+                counts[ident][name] = count
+        return {ident: {'counts': user_counts} for ident, user_counts in counts.items()}
 
     def from_dict(self, data, new_user=False):
         for field in ['username', 'email', 'threshold', 'days']:
@@ -430,12 +656,15 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         now = datetime.utcnow()
         if self.token and self.token_expiration > now + timedelta(seconds=60):
             return self.token
+        if self.token:
+            token_cache.invalidate(self.token)
         self.token = base64.b64encode(os.urandom(24)).decode('utf-8')
         self.token_expiration = now + timedelta(seconds=expires_in)
         db.session.add(self)
         return self.token
 
     def revoke_token(self):
+        token_cache.invalidate(self.token)
         self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
 
     @staticmethod
@@ -445,20 +674,269 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             return None
         return user
 
+    @staticmethod
+    def check_token_id(token):
+        """
+        Returns the id of the user a valid token belongs to, or None,
+        from the TokenCache when the token was verified recently.
+        """
+        cached = token_cache.get(token)
+        if cached is None:
+            row = db.session.query(User.id, User.token_expiration).filter(
+                User.token == token).first()
+            if row is None:
+                return None
+            cached = tuple(row)
+            token_cache.add(token, *cached)
+        user_id, expiration = cached
+        if expiration < datetime.utcnow():
+            return None
+        return user_id
+
+    def get_access_token(self, expires_in=None, family=None):
+        """
+        Returns a short lived signed access token, verified from its
+        signature alone, see check_access_token. Expires after
+        JWT_ACCESS_EXPIRY seconds (default 900) unless expires_in is given.
+        family: the RefreshToken family of the session, as the fam claim
+        """
+        if expires_in is None:
+            expires_in = current_app.config.get("JWT_ACCESS_EXPIRY", 900)
+        now = time()
+        claims = {
+            "sub": self.id,
+            "type": "access",
+            "jti": secrets.token_hex(8),
+            "iat": int(now),
+            "exp": int(now + expires_in),
+        }
+        if family is not None:
+            claims["fam"] = family
+        return jwt.encode(
+            claims,
+            current_app.config["SECRET_KEY"],
+            algorithm="HS256",
+        ).decode("utf-8")
+
+    @staticmethod
+    def check_access_token(token):
+        """
+        Returns the claims of a valid signed access token, or None.
+
+        Checks the signature, expiry and the deny list of revoked
+        tokens, without a query per call.
+        """
+        try:
+            claims = jwt.decode(
+                token, current_app.config["SECRET_KEY"], algorithms=["HS256"]
+            )
+        except jwt.InvalidTokenError:
+            return None
+        if claims.get("type") != "access" or deny_list.denied(claims.get("jti")):
+            return None
+        return claims
+
+    def frequency_tasks_for_date(self, date):
+        """
+        Returns a query of the frequency tasks that recur on date.
+
+        The day offset, frequency modulo, to_date and exclusion
+        checks all run in the database.
+        """
+        exclusions = db.session.query(Post.exclude).filter(
+            Post.user_id == self.id, Post.date == date, Post.exclude != None
+        )
+        offset = day_offset(date, Post.date)
+        return self.posts.filter(
+            Post.frequency > 0,
+            Post.date < date,
+            offset > 0,
+            offset % Post.frequency == 0,
+            Post.to_date_after(date),
+            ~Post.id.in_(exclusions),
+        )
+
+    def tasks_for_date(self, date):
+        """
+        Returns the tasks set on date and the frequency tasks recurring on it.
+
+        Recurring tasks are read from the task occurrence index when it
+        covers date, otherwise they are found with a recurrence query.
+        """
+        todos = self.posts.filter_by(date=date).all()
+        if self.occurrences_cover(date):
+            frequency_tasks = (
+                self.posts.join(TaskOccurrence, TaskOccurrence.post_id == Post.id)
+                .filter(TaskOccurrence.user_id == self.id, TaskOccurrence.date == date)
+                .all()
+            )
+        else:
+            frequency_tasks = self.frequency_tasks_for_date(date).all()
+        return todos, frequency_tasks
+
+    def get_tasks_in_range(self, start, end):
+        """
+        Returns a dict of date to daily tasks for every date from start to end.
+
+        Each day holds the same tasks as get_daily_tasks, with all
+        frequency tasks expanded for the whole range in one pass.
+        """
+        days = {
+            start + timedelta(days=offset): []
+            for offset in range((end - start).days + 1)
+        }
+        todos = self.posts.filter(Post.date >= start, Post.date <= end).all()
+        for todo in todos:
+            if todo.date in days and todo.done is False:
+                days[todo.date].append(todo)
+        if self.occurrences_cover(start, end):
+            occurrences = (
+                db.session.query(TaskOccurrence.date, Post)
+                .join(Post, TaskOccurrence.post_id == Post.id)
+                .filter(
+                    TaskOccurrence.user_id == self.id,
+                    TaskOccurrence.date >= start,
+                    TaskOccurrence.date <= end,
+                )
+                .order_by(TaskOccurrence.date, Post.id)
+            )
+        else:
+            occurrences = self.expand_frequency_tasks(start, end)
+        for day, task in occurrences:
+            if task not in days[day]:
+                days[day].append(task)
+        return days
+
+    def add_push_subscription(self, subscription):
+        """
+        Stores a device's push subscription (the browser's subscription
+        dict), replacing any earlier one with the same endpoint.
+        """
+        endpoint = subscription["endpoint"]
+        device = PushSubscription.query.filter_by(endpoint=endpoint).first()
+        if device is None:
+            device = PushSubscription(endpoint=endpoint)
+            db.session.add(device)
+        device.user_id = self.id
+        device.subscription = json.dumps(subscription)
+        return device
+
+    def local_date(self, moment=None):
+        """
+        Returns the midnight of the user's local day at moment, UTC and
+        now by default, moved forward by the user's utc_offset.
+        """
+        moment = (moment or datetime.utcnow()) + timedelta(minutes=self.utc_offset or 0)
+        return datetime.combine(moment.date(), datetime.min.time())
+
+    def reminders(self, start, end):
+        """
+        Returns a Reminder for each of the user's tasks ending after start,
+        up to and including end.
+
+        start and end are UTC, tasks end at local times, so each due time
+        is moved back by the user's utc_offset.
+        """
+        from app.scheduler import Reminder
+
+        offset = timedelta(minutes=self.utc_offset or 0)
+        first = datetime.combine((start + offset).date(), datetime.min.time())
+        last = datetime.combine((end + offset).date(), datetime.min.time())
+        reminders = []
+        for day, tasks in self.get_tasks_in_range(first, last).items():
+            for task in tasks:
+                if task.end_time is None:
+                    continue
+                due = day + timedelta(minutes=task.end_time) - offset
+                if start < due <= end:
+                    reminders.append(Reminder(due, self.id, task.id, task.body))
+        return reminders
+
+    def expand_frequency_tasks(self, start, end, series=None):
+        """
+        Expands frequency tasks into (date, task) pairs between
+        start and end in a single pass.
+
+        series: the frequency tasks to expand, defaults to all of them.
+        """
+        if series is None:
+            series = self.posts.filter(
+                Post.frequency > 0, Post.date < end, Post.to_date_after(start)
+            ).all()
+        exclusions = set(
+            db.session.query(Post.exclude, Post.date).filter(
+                Post.user_id == self.id,
+                Post.exclude != None,
+                Post.date >= start,
+                Post.date <= end,
+            )
+        )
+        return expand_series(series, exclusions, start, end)
+
+    def occurrence_window(self, today=None):
+        """
+        Returns the rolling date range kept in the task occurrence index.
+
+        This reaches back over the depression check days and forward
+        by OCCURRENCE_HORIZON_DAYS (90 by default).
+        """
+        if today is None:
+            today = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+        ahead = current_app.config.get("OCCURRENCE_HORIZON_DAYS", 90)
+        return (
+            today - timedelta(days=self.days or 0),
+            today + timedelta(days=ahead),
+        )
+
+    def occurrences_cover(self, start, end=None):
+        """Checks that the task occurrence index covers start to end."""
+        if self.occurrences_from is None or self.occurrences_to is None:
+            return False
+        return self.occurrences_from <= start and (end or start) <= self.occurrences_to
+
+    def rebuild_occurrences(self, today=None):
+        """Rebuilds all of the user's task occurrences for the rolling window."""
+        start, end = self.occurrence_window(today)
+        TaskOccurrence.query.filter_by(user_id=self.id).delete()
+        self.add_occurrences(self.expand_frequency_tasks(start, end))
+        self.occurrences_from = start
+        self.occurrences_to = end
+
+    def sync_occurrences(self, task):
+        """
+        Refreshes the task occurrences affected by a created or edited task.
+
+        These are the task's own and, for an edited occurrence,
+        those of the frequency task it was split from.
+        """
+        self.tasks_changed = datetime.utcnow()
+        if self.occurrences_from is None:
+            self.rebuild_occurrences()
+            return
+        idents = {ident for ident in (task.id, task.exclude) if ident}
+        TaskOccurrence.query.filter(
+            TaskOccurrence.user_id == self.id, TaskOccurrence.post_id.in_(idents)
+        ).delete(synchronize_session=False)
+        series = self.posts.filter(Post.id.in_(idents), Post.frequency > 0).all()
+        self.add_occurrences(
+            self.expand_frequency_tasks(
+                self.occurrences_from, self.occurrences_to, series=series
+            )
+        )
+
+    def add_occurrences(self, occurrences):
+        """Bulk inserts (date, task) pairs into the task occurrence index."""
+        db.session.bulk_insert_mappings(
+            TaskOccurrence,
+            [
+                {"user_id": self.id, "post_id": task.id, "date": day}
+                for day, task in occurrences
+            ],
+        )
+
     def get_daily_tasks(self, date):
         date = datetime.strptime(date, "%d-%m-%Y")
-        all_frequency_tasks = self.posts.filter(Post.frequency != None).all()
-        todos = self.posts.filter_by(date=date)
-        exclusions = [todo.exclude for todo in todos if todo.exclude]
-        frequency_tasks = [
-            task
-            for task in all_frequency_tasks
-            if task.frequency > 0
-            and (date - task.date).days > 0
-            and ((date - task.date).days % task.frequency) == 0
-            and task.date < date
-            and task.id not in exclusions
-        ]
+        todos, frequency_tasks = self.tasks_for_date(date)
         all_tasks = [task for task in todos if task.done is False]
         [all_tasks.append(todo) for todo in frequency_tasks if todo not in todos]
         return all_tasks
@@ -470,6 +948,13 @@ def load_user(id):
     return User.query.get(int(id))
 
 
+@event.listens_for(User, "after_delete")
+def forget_deleted_user_token(mapper, connection, user):
+    """Stops the TokenCache accepting the token of a deleted user."""
+    if user.token:
+        token_cache.invalidate(user.token)
+
+
 class Post(db.Model):
     """
     db schema model for to do tasks.
@@ -496,20 +981,39 @@ class Post(db.Model):
     exclude = db.Column(db.Integer, nullable=True)
     to_date = db.Column(db.DateTime, nullable=True)
 
-    def to_dict(self):
-        print(self.to_date)
-        data = {
-            'id': self.id,
-            'body': self.body,
-            'start_time': self.start_time,
-            'end_time': self.end_time,
-            'color': self.color,
-            'frequency': self.frequency,
-            'to_date': self.to_date,
-            'done': self.done,
-            'exclude': self.exclude
-        }
-        return data
+    __table_args__ = (
+        db.Index("ix_post_user_id_date", "user_id", "date"),
+        db.Index("ix_post_user_id_frequency", "user_id", "frequency"),
+        db.Index("ix_post_user_id_exclude", "user_id", "exclude"),
+    )
+
+    API_FIELDS = (
+        'id', 'body', 'start_time', 'end_time', 'color', 'frequency', 'to_date',
+        'done', 'exclude'
+    )
+    FIELD_COLUMNS = {}
+
+    def to_dict(self, fields=None):
+        """fields: the API_FIELDS to include, by default all of them"""
+        getters = {name: partial(getattr, self, name) for name in self.API_FIELDS}
+        getters['frequency'] = self.api_frequency
+        return api_dict(getters, fields or self.API_FIELDS)
+
+    def api_frequency(self):
+        """
+        The frequency the API reports. A time limited series reports null,
+        as it did when it was stored one task per occurrence.
+        """
+        return None if self.to_date and self.frequency else self.frequency
+
+    def api_frequency_update(self, frequency):
+        """
+        The frequency to store for one sent to the API, where the null
+        reported for a time limited series keeps its interval.
+        """
+        if frequency is None and self.to_date and self.frequency:
+            return self.frequency
+        return frequency
 
     def from_dict(self, data):
         for field in ['body', 'done', 'start_time', 'end_time', 'user_id', 'date', 'hour', 'frequency', 'to_date', 'color']:
@@ -536,15 +1040,23 @@ class Post(db.Model):
             self.form.frequency.data = None
 
     def add_multiple_tasks(self):
-        """Adds multiple tasks, triggered when a repeating task has a date_to value."""
-        for self.i in range(0, (self.to_date - self.date).days + 1, self.form.frequency.data):
-            self.task_to_be_added = self.add_single_task(to_date=self.to_date)
-            db.session.add(self.task_to_be_added)
-            self.commit_flush()
-            if self.i == 0:
-                self.ident = self.task_to_be_added.id
-            self.task_to_be_added.exclude = self.ident
-            db.session.commit()
+        """
+        Adds a repeating task with a date_to value.
+
+        The series is stored as a single rule (date, frequency, to_date),
+        its occurrences are expanded when read.
+        """
+        self.task_to_be_added = self.add_single_task(
+            date=self.date, frequency=self.form.frequency.data, to_date=self.to_date
+        )
+        db.session.add(self.task_to_be_added)
+        db.session.commit()
+        self.ident = self.task_to_be_added.id
+
+    @staticmethod
+    def to_date_after(date):
+        """Filters out frequency tasks whose to_date is before date."""
+        return db.or_(Post.to_date == None, Post.to_date >= date)
 
     def add_single_task(self, date=None, frequency=None, to_date=None):
         """Adds a single task."""
@@ -623,37 +1135,136 @@ class Post(db.Model):
         self.parent_task = current_user.posts.filter_by(
             id=self.task_to_be_edited.exclude
         ).first()
-        if not self.parent_task.to_date:
+        if self.parent_task.is_rule():
             self.parent_task.frequency = self.form.frequency.data
-        self.tasks = [
-            task
-            for task in current_user.posts.all()
-            if task.exclude == self.task_to_be_edited.exclude
-        ]
-        for i, task in enumerate(self.tasks):
-            task.body = self.form.task.data
-            task.hour = self.form.start_time.data.hour
-            task.done = self.form.done.data
-            if self.form.done.data is True:
-                task.frequency = 0
-            elif self.form.frequency.data != None and self.form.frequency.data == 0:
-                if i != len(self.tasks) - 1:
-                    task.done = True
-            elif (
-                self.form.frequency.data
-                and (
-                    (self.parent_task.date - task.date).days
-                    % int(self.form.frequency.data)
-                )
-                != 0
-            ):
-                task.done = True
-            task.color = self.form.color.data
-            task.user_id = current_user.id
-            task.start_time = self.minutes
-            task.end_time = self.end
+        Post.update_series(
+            current_user.id,
+            self.task_to_be_edited.exclude,
+            {
+                "body": self.form.task.data,
+                "hour": self.form.start_time.data.hour,
+                "color": self.form.color.data,
+                "user_id": current_user.id,
+                "start_time": self.minutes,
+                "end_time": self.end,
+            },
+            done=self.form.done.data,
+            frequency=self.form.frequency.data,
+            parent_date=self.parent_task.date,
+        )
         flash("Your tasks have been updated!", "success")
 
+    @staticmethod
+    def update_series(user_id, series_id, values, done, frequency, parent_date):
+        """
+        Updates every task of a series with a single UPDATE statement.
+
+        values: columns set on every task in the series
+        done: the edited done value
+        frequency: the edited frequency, which decides the done rule.
+            If done is True every task is done and stops repeating,
+            0 marks all but the last task as done, any other frequency
+            marks tasks that no longer fall on it (counted from
+            parent_date) as done.
+        """
+        series = Post.query.filter(Post.user_id == user_id, Post.exclude == series_id)
+        values = dict(values)
+        if done is True:
+            values.update(done=True, frequency=0)
+        elif frequency == 0:
+            last = db.session.query(db.func.max(Post.id)).filter(
+                Post.user_id == user_id, Post.exclude == series_id
+            ).scalar()
+            values["done"] = db.case([(Post.id == last, done)], else_=True)
+        elif frequency:
+            values["done"] = db.case(
+                [(day_offset(parent_date, Post.date) % int(frequency) != 0, True)],
+                else_=done,
+            )
+        else:
+            values["done"] = done
+        series.update(values, synchronize_session="fetch")
+
+    def complete_occurrence(self, date):
+        """
+        Marks the task done on date.
+
+        An occurrence of a frequency task after its own date is
+        completed with a done override, leaving the rest of the series
+        due. Completing it again marks the same override done rather
+        than adding another. Returns the task that was marked done.
+        """
+        if not any(occurrence_dates(self.date, self.frequency, date, date, self.to_date)):
+            self.done = True
+            return self
+        override = Post.query.filter(
+            Post.user_id == self.user_id,
+            Post.exclude == self.id,
+            Post.date == date,
+            Post.id != self.id,
+        ).first()
+        if override is not None:
+            override.done = True
+            return override
+        override = Post(
+            body=self.body,
+            hour=self.hour,
+            date=date,
+            done=True,
+            user_id=self.user_id,
+            start_time=self.start_time,
+            end_time=self.end_time,
+            color=self.color,
+            frequency=0,
+            exclude=self.id,
+        )
+        self.exclude = self.id
+        db.session.add(override)
+        return override
+
+    def is_rule(self):
+        """
+        Checks whether a series parent is stored as a rule.
+
+        Time limited series created before rules were stored as one
+        task per occurrence without a frequency, changing the
+        frequency of those would repeat every occurrence.
+        """
+        return not self.to_date or bool(self.frequency)
+
+    @staticmethod
+    def compact_series(tasks):
+        """
+        Converts a time limited series stored as one task per occurrence
+        into a rule with sparse overrides.
+
+        tasks: the series, ordered by date, the first one being the parent.
+        Occurrences that are unchanged from the parent are deleted, done
+        or edited ones are kept as overrides. Series that do not fall on
+        a regular interval are left alone. Returns whether the series
+        was compacted.
+        """
+        parent = tasks[0]
+        if len(tasks) < 2 or parent.frequency or parent.exclude != parent.id:
+            return False
+        interval = (tasks[1].date - parent.date).days
+        if interval <= 0 or any(
+            task.date != parent.date + timedelta(days=interval * position)
+            for position, task in enumerate(tasks)
+        ) or tasks[-1].date + timedelta(days=interval) <= parent.to_date:
+            return False
+        parent.frequency = interval
+        for task in tasks[1:]:
+            if task.done is not False or any(
+                getattr(task, field) != getattr(parent, field)
+                for field in ("body", "start_time", "end_time", "color")
+            ):
+                task.frequency = 0
+                task.to_date = None
+            else:
+                db.session.delete(task)
+        return True
+
     def edit_all_tasks(self):
         """Edits all tasks in a series."""
         self.task_to_be_edited_input()
@@ -668,6 +1279,55 @@ class Post(db.Model):
             flash("Your task is complete!", "success")
 
 
+class TaskOccurrence(db.Model):
+    """
+    db schema for the materialized occurrences of frequency tasks.
+
+    Holds one row per user, date and frequency task over a rolling
+    window (see User.occurrence_window), so that finding the tasks
+    recurring on a date is an indexed lookup.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    post_id = db.Column(db.Integer, db.ForeignKey("post.id"), index=True)
+    date = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index("ix_task_occurrence_user_id_date", "user_id", "date"),
+    )
+
+    def __repr__(self):
+        """returns a representation of the TaskOccurrence object."""
+        return "<TaskOccurrence {} {}>".format(self.post_id, self.date)
+
+
+class DailyCompletion(db.Model):
+    """
+    db schema for the daily completion rollup.
+
+    Holds the number of due and done tasks per user and date
+    (see User.count_completion), so completion rates over a period
+    are read from a handful of rows.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    date = db.Column(db.DateTime)
+    due_count = db.Column(db.Integer, default=0)
+    done_count = db.Column(db.Integer, default=0)
+
+    __table_args__ = (
+        db.Index("ix_daily_completion_user_id_date", "user_id", "date", unique=True),
+    )
+
+    def __repr__(self):
+        """returns a representation of the DailyCompletion object."""
+        return "<DailyCompletion {} {}/{}>".format(
+            self.date, self.done_count, self.due_count
+        )
+
+
 class Message(db.Model):
     """db schema for private messages sent by the users."""
 
@@ -677,17 +1337,325 @@ class Message(db.Model):
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index("ix_message_recipient_id_timestamp", "recipient_id", "timestamp"),
+        db.Index("ix_message_sender_id_timestamp", "sender_id", "timestamp"),
+    )
+
     def __repr__(self):
         """returns a representation of the Message object."""
         return "<Message {}>".format(self.body)
 
-    def to_dict(self):
-        data = {
-            'id': self.id,
-            'body': self.body,
-            'sender_id': self.sender_id,
-            'recipient_id': self.recipient_id,
-            'timestamp': datetime.strftime(self.timestamp, "%d-%m-%y %H:%M")
-        }
-        return data
+    API_FIELDS = ('id', 'body', 'sender_id', 'recipient_id', 'timestamp')
+    FIELD_COLUMNS = {}
+
+    def to_dict(self, fields=None):
+        """fields: the API_FIELDS to include, by default all of them"""
+        getters = {name: partial(getattr, self, name) for name in self.API_FIELDS}
+        getters['timestamp'] = lambda: datetime.strftime(self.timestamp, "%d-%m-%y %H:%M")
+        return api_dict(getters, fields or self.API_FIELDS)
+
+
+
+class PushSubscription(db.Model):
+    """
+    db schema for the push subscription of each of a user's devices.
+
+    endpoint: The push service url of the device, unique so that a
+        device subscribing again replaces its old subscription
+    subscription: The subscription JSON sent by the browser
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
+    endpoint = db.Column(db.String(500), index=True, unique=True)
+    subscription = db.Column(db.String(1000))
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        """returns a representation of the PushSubscription object."""
+        return "<PushSubscription {}>".format(self.endpoint)
+
+
+class Outbox(db.Model):
+    """
+    db schema for the transactional outbox.
+
+    Side effects are added as rows in the same commit as the change
+    that causes them, then delivered by `flask outbox-worker`.
+
+    kind: "email" or "push"
+    payload: JSON of what to deliver
+    key: Optional idempotency key, a row is only added once per key
+    status: "pending", "sent", or "failed" once out of attempts
+    attempts: The number of failed deliveries so far
+    available_at: When the row may next be delivered
+    locked_by: The claim of the worker delivering the row
+    locked_until: When that claim lapses
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20))
+    payload = db.Column(db.Text)
+    key = db.Column(db.String(120), unique=True, nullable=True)
+    status = db.Column(db.String(20), default="pending")
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.String(500), nullable=True)
+    available_at = db.Column(db.DateTime, default=datetime.utcnow)
+    locked_by = db.Column(db.String(64), index=True, nullable=True)
+    locked_until = db.Column(db.DateTime, nullable=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index("ix_outbox_status_available_at", "status", "available_at"),
+    )
+
+    def __repr__(self):
+        """returns a representation of the Outbox object."""
+        return "<Outbox {} {}>".format(self.kind, self.id)
+
+    @staticmethod
+    def add(kind, payload, key=None):
+        """
+        Adds a row to the session without committing, so that it is
+        committed with the caller's change. Returns None if a row
+        with key was already added.
+
+        A keyed row is inserted with the database's insert or ignore,
+        so a concurrent insert of the same key is skipped rather than
+        failing the caller's transaction.
+        """
+        row = Outbox(kind=kind, payload=json.dumps(payload), key=key)
+        if key is None:
+            db.session.add(row)
+            return row
+        values = {"kind": row.kind, "payload": row.payload, "key": key}
+        dialect = db.session.get_bind().dialect.name
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+
+            statement = insert(Outbox.__table__).values(values).on_conflict_do_nothing(
+                index_elements=["key"]
+            )
+        elif dialect in ("sqlite", "mysql"):
+            statement = Outbox.__table__.insert().values(values).prefix_with(
+                "OR IGNORE" if dialect == "sqlite" else "IGNORE"
+            )
+        else:
+            try:
+                with db.session.begin_nested():
+                    db.session.add(row)
+            except IntegrityError:
+                return None
+            return row
+        result = db.session.execute(statement)
+        if not result.rowcount:
+            return None
+        return Outbox.query.get(result.inserted_primary_key[0])
+
+    @staticmethod
+    def email(subject, sender, recipients, text_body, html_body, key=None):
+        """Adds an email to the outbox."""
+        return Outbox.add(
+            "email",
+            {
+                "subject": subject,
+                "sender": sender,
+                "recipients": recipients,
+                "text_body": text_body,
+                "html_body": html_body,
+            },
+            key=key,
+        )
+
+    @staticmethod
+    def push(user, data):
+        """Adds a push notification to the outbox for each of user's devices."""
+        return [
+            Outbox.add("push", {"subscription_id": device.id, "data": data})
+            for device in user.push_subscriptions
+        ]
+
+    @staticmethod
+    def claim(token, batch_size, lease):
+        """
+        Claims up to batch_size deliverable rows for a worker and commits.
+
+        Rows are claimed with a conditional UPDATE, so when several
+        workers race for the same rows each row goes to only one of
+        them. Rows of a worker that died are claimed again once their
+        lease (in seconds) lapses. Returns the claimed rows.
+        """
+        now = datetime.utcnow()
+        claimable = db.and_(
+            Outbox.status == "pending",
+            Outbox.available_at <= now,
+            db.or_(Outbox.locked_until == None, Outbox.locked_until < now),
+        )
+        ids = [
+            ident
+            for (ident,) in db.session.query(Outbox.id)
+            .filter(claimable)
+            .order_by(Outbox.id)
+            .limit(batch_size)
+        ]
+        if not ids:
+            return []
+        Outbox.query.filter(Outbox.id.in_(ids), claimable).update(
+            {
+                Outbox.locked_by: token,
+                Outbox.locked_until: now + timedelta(seconds=lease),
+            },
+            synchronize_session=False,
+        )
+        db.session.commit()
+        return Outbox.query.filter_by(locked_by=token).order_by(Outbox.id).all()
+
+    def sent(self):
+        """Marks the row delivered."""
+        self.status = "sent"
+        self.sent_at = datetime.utcnow()
+        self.locked_by = None
+        self.locked_until = None
+
+    def failed(self, error, max_attempts, backoff):
+        """
+        Records a failed delivery, retrying after backoff seconds
+        doubled per attempt, until max_attempts have failed.
+        """
+        self.attempts = (self.attempts or 0) + 1
+        self.last_error = str(error)[:500]
+        self.locked_by = None
+        self.locked_until = None
+        if self.attempts >= max_attempts:
+            self.status = "failed"
+        else:
+            self.available_at = datetime.utcnow() + timedelta(
+                seconds=backoff * 2 ** (self.attempts - 1)
+            )
+
+
+class RefreshToken(db.Model):
+    """
+    db schema for API refresh tokens, stored as sha256 hashes.
+
+    Each refresh exchanges the token for a new one in the same family,
+    one family per login session.
+    family: The id of the first token of the family
+    used: Set once the token has been exchanged, presenting it again
+        revokes the whole family as the token must have been stolen
+    """
 
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
+    token_hash = db.Column(db.String(64), index=True, unique=True)
+    family = db.Column(db.Integer, index=True, nullable=True)
+    expires = db.Column(db.DateTime)
+    used = db.Column(db.Boolean, default=False)
+    revoked = db.Column(db.Boolean, default=False)
+
+    def __repr__(self):
+        """returns a representation of the RefreshToken object."""
+        return "<RefreshToken {} {}>".format(self.user_id, self.id)
+
+    @staticmethod
+    def hash(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    @staticmethod
+    def issue(user, family=None):
+        """
+        Adds a refresh token for user, valid for JWT_REFRESH_EXPIRY
+        seconds (default 30 days), without committing.
+
+        Returns (token, family), a new family unless one is given.
+        """
+        token = secrets.token_urlsafe(32)
+        row = RefreshToken(
+            user_id=user.id,
+            token_hash=RefreshToken.hash(token),
+            family=family,
+            expires=datetime.utcnow()
+            + timedelta(seconds=current_app.config.get("JWT_REFRESH_EXPIRY", 2592000)),
+        )
+        db.session.add(row)
+        if family is None:
+            db.session.flush()
+            row.family = row.id
+        return token, row.family
+
+    @staticmethod
+    def rotate(token):
+        """
+        Exchanges a refresh token for a new one, without committing.
+
+        The token is marked used with a conditional UPDATE, so of two
+        concurrent exchanges only one succeeds. Returns (user, new
+        refresh token, family), or None if the token is unknown,
+        expired, revoked, was already exchanged or its user was deleted.
+        """
+        token_hash = RefreshToken.hash(token)
+        claimed = RefreshToken.query.filter(
+            RefreshToken.token_hash == token_hash,
+            RefreshToken.used == False,
+            RefreshToken.revoked == False,
+            RefreshToken.expires >= datetime.utcnow(),
+        ).update({RefreshToken.used: True}, synchronize_session=False)
+        row = RefreshToken.query.filter_by(token_hash=token_hash).first()
+        if row is None:
+            return None
+        if not claimed:
+            if row.used:
+                RefreshToken.revoke_family(row.family)
+            return None
+        user = User.query.get(row.user_id)
+        if user is None:
+            RefreshToken.revoke_family(row.family)
+            return None
+        return (user,) + RefreshToken.issue(user, row.family)
+
+    @staticmethod
+    def revoke_family(family):
+        """Revokes the refresh tokens of one login session, without committing."""
+        RefreshToken.query.filter_by(family=family, revoked=False).update(
+            {RefreshToken.revoked: True}, synchronize_session=False
+        )
+
+    @staticmethod
+    def revoke_user(user_id):
+        """Revokes every refresh token of a user, without committing."""
+        RefreshToken.query.filter_by(user_id=user_id, revoked=False).update(
+            {RefreshToken.revoked: True}, synchronize_session=False
+        )
+
+
+class DeniedToken(db.Model):
+    """
+    db schema for the deny list of revoked signed access tokens.
+
+    Rows are only needed until the token expires, expired rows are
+    pruned as tokens are denied.
+    jti: The id claim of the revoked token
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    jti = db.Column(db.String(32), index=True, unique=True)
+    expires = db.Column(db.DateTime, index=True)
+
+    def __repr__(self):
+        """returns a representation of the DeniedToken object."""
+        return "<DeniedToken {}>".format(self.jti)
+
+    @staticmethod
+    def deny(jti, exp):
+        """
+        Adds an access token to the deny list, without committing.
+        exp: its expiry claim, in seconds since the epoch
+        """
+        now = datetime.utcnow()
+        DeniedToken.query.filter(DeniedToken.expires < now).delete(
+            synchronize_session=False
+        )
+        db.session.add(DeniedToken(jti=jti, expires=datetime.utcfromtimestamp(exp)))
+        deny_list.add(jti)
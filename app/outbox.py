@@ -0,0 +1,98 @@
+import json
+import os
+import socket
+import time
+import uuid
+from threading import Condition
+
+from app import db, push
+from app.email import mail_queue, outbox_message
+from app.models import Outbox, PushSubscription
+
+
+def deliver_batch(app, rows):
+    """
+    Delivers claimed outbox rows and records each outcome.
+
+    Emails are handed to the mail delivery pool, which sends them over
+    shared SMTP connections, and waited on. Push notifications are
+    sent through the shared push session. Each row is only marked
+    sent once delivery succeeded, a worker dying part way through
+    leaves its rows to be claimed again. Emails still unanswered when
+    the rows' lease (OUTBOX_LEASE) runs out are marked failed.
+    """
+    results = {}
+    finished = Condition()
+
+    def done(row_id):
+        def record(msg, error):
+            with finished:
+                results[row_id] = error
+                finished.notify()
+
+        return record
+
+    emails = [row for row in rows if row.kind == "email"]
+    for row in emails:
+        msg = outbox_message(json.loads(row.payload), row.id)
+        if not mail_queue.send(app, msg, done(row.id)):
+            results[row.id] = "mail queue full"
+    for row in rows:
+        if row.kind == "push":
+            results[row.id] = deliver_push(app, json.loads(row.payload))
+        elif row.kind != "email":
+            results[row.id] = f"unknown outbox kind {row.kind}"
+    with finished:
+        finished.wait_for(
+            lambda: len(results) == len(rows), app.config.get("OUTBOX_LEASE", 300)
+        )
+        outcomes = dict(results)
+    for row in rows:
+        outcomes.setdefault(row.id, "no delivery result within the lease")
+        if outcomes[row.id] is None:
+            row.sent()
+        else:
+            row.failed(
+                outcomes[row.id],
+                app.config.get("OUTBOX_MAX_ATTEMPTS", 5),
+                app.config.get("OUTBOX_BACKOFF", 30),
+            )
+            app.logger.warning(f"Outbox {row.id} not delivered: {outcomes[row.id]}")
+    db.session.commit()
+
+
+def deliver_push(app, payload):
+    """Sends an outbox push notification, returns None or the error message."""
+    device = PushSubscription.query.get(payload["subscription_id"])
+    if device is None:
+        return None
+    push.open(app)
+    if push.deliver(app, device.id, device.subscription, payload["data"], retries=0):
+        return None
+    return "push service error"
+
+
+def run_worker(app, batch_size=None, poll=1, once=False):
+    """
+    Claims and delivers outbox rows in batches until interrupted,
+    or with once, until nothing is left to deliver.
+
+    Any number of workers can run side by side, see Outbox.claim.
+    Configured with OUTBOX_BATCH_SIZE (default 50), OUTBOX_LEASE
+    (300 seconds), OUTBOX_MAX_ATTEMPTS (5) and OUTBOX_BACKOFF (30
+    seconds, doubled per attempt). Returns the number of rows handled.
+    """
+    batch_size = batch_size or app.config.get("OUTBOX_BATCH_SIZE", 50)
+    worker = f"{socket.gethostname()[:32]}:{os.getpid()}"
+    handled = 0
+    while True:
+        token = f"{worker}:{uuid.uuid4().hex[:12]}"
+        rows = Outbox.claim(token, batch_size, app.config.get("OUTBOX_LEASE", 300))
+        if rows:
+            deliver_batch(app, rows)
+            handled += len(rows)
+        elif once:
+            return handled
+        else:
+            db.session.remove()
+            time.sleep(poll)
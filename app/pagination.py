@@ -0,0 +1,92 @@
+import json
+import operator
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+
+NEXT = "n"
+PREV = "p"
+
+KeysetPage = namedtuple("KeysetPage", ["items", "next_cursor", "prev_cursor"])
+
+
+def encode_cursor(direction, values):
+    """Packs a direction and the keys of the last item seen into an opaque cursor."""
+    values = [value.isoformat() if isinstance(value, datetime) else value
+              for value in values]
+    return urlsafe_b64encode(json.dumps([direction, values]).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, keys):
+    """
+    Unpacks a cursor made by encode_cursor for keys.
+
+    Returns (direction, values), raises ValueError if the cursor is invalid.
+    """
+    try:
+        direction, values = json.loads(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor.")
+    if direction not in (NEXT, PREV) or not isinstance(values, list) \
+            or len(values) != len(keys):
+        raise ValueError("Invalid cursor.")
+    decoded = []
+    for key, value in zip(keys, values):
+        if key.type.python_type is datetime:
+            if not isinstance(value, str):
+                raise ValueError("Invalid cursor.")
+            value = datetime.fromisoformat(value)
+        elif not isinstance(value, key.type.python_type):
+            raise ValueError("Invalid cursor.")
+        decoded.append(value)
+    return direction, decoded
+
+
+def beyond(keys, values, descending):
+    """
+    Filters for rows ordered after values, spelt out column by column
+    (a > x or a = x and b > y). The leading a >= x bound lets the
+    database seek straight to values in the index on the keys.
+    """
+    compare = operator.lt if descending else operator.gt
+    bound = operator.le if descending else operator.ge
+    condition = compare(keys[-1], values[-1])
+    for key, value in zip(reversed(keys[:-1]), reversed(values[:-1])):
+        condition = or_(compare(key, value), and_(key == value, condition))
+    if len(keys) > 1:
+        condition = and_(bound(keys[0], values[0]), condition)
+    return condition
+
+
+def keyset_paginate(query, keys, per_page, cursor=None, descending=False):
+    """
+    Reads the page of query after (or before) cursor, ordered by keys.
+
+    keys: columns that together are unique, ending with the primary key
+    Unlike paginate, there is no OFFSET to scan past or COUNT(*) to run,
+    so deep pages cost the same as the first. Raises ValueError for an
+    invalid cursor.
+    """
+    direction, values = decode_cursor(cursor, keys) if cursor else (NEXT, None)
+    backwards = direction == PREV
+    reverse = descending != backwards
+    if values is not None:
+        query = query.filter(beyond(keys, values, reverse))
+    order = [key.desc() if reverse else key.asc() for key in keys]
+    items = query.order_by(None).order_by(*order).limit(per_page + 1).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+    has_next = values is not None if backwards else more
+    has_prev = more if backwards else values is not None
+    next_cursor = prev_cursor = None
+    if items and has_next:
+        next_cursor = encode_cursor(NEXT, [getattr(items[-1], key.key) for key in keys])
+    if items and has_prev:
+        prev_cursor = encode_cursor(PREV, [getattr(items[0], key.key) for key in keys])
+    return KeysetPage(items, next_cursor, prev_cursor)
+
@@ -0,0 +1,217 @@
+import json
+import os
+import time
+from contextlib import nullcontext
+from queue import Full, Queue
+from threading import Lock, Thread
+from urllib.parse import urlparse
+
+from flask import has_app_context
+from py_vapid import Vapid
+from pywebpush import WebPusher
+from requests import RequestException, Session
+from requests.adapters import HTTPAdapter
+
+
+EXPIRED_STATUSES = (404, 410)
+
+
+class PushQueue(object):
+    """
+    Sends web push notifications from a bounded queue drained by a
+    pool of worker threads, so requests never wait on a push service.
+
+    All workers post through one pooled HTTP session, so connections
+    to a push service are reused across notifications and devices,
+    and share one VapidCache.
+
+    Configured with PUSH_WORKERS (default 2), PUSH_QUEUE_SIZE (1000),
+    PUSH_RETRIES (3) and PUSH_BACKOFF (1 second, doubled per retry).
+    """
+
+    def __init__(self, app=None):
+        self.queue = None
+        self.session = None
+        self.workers = []
+        self.lock = Lock()
+        self.vapid = VapidCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("PUSH_WORKERS", 2)
+        app.config.setdefault("PUSH_QUEUE_SIZE", 1000)
+        app.config.setdefault("PUSH_RETRIES", 3)
+        app.config.setdefault("PUSH_BACKOFF", 1)
+        app.config.setdefault("VAPID_CACHE", True)
+        app.config.setdefault("VAPID_EXPIRY", 12 * 60 * 60)
+        app.config.setdefault("VAPID_REFRESH", 5 * 60)
+        app.extensions["push"] = self
+
+    def send(self, app, subscriptions, data):
+        """
+        Queues a notification to each PushSubscription in subscriptions.
+
+        Returns the number queued, notifications that do not fit
+        in the queue are dropped.
+        """
+        self.start(app)
+        queued = 0
+        for device in subscriptions:
+            try:
+                self.queue.put_nowait((app, device.id, device.subscription, data))
+            except Full:
+                app.logger.warning(f"Push queue full, notification to {device} dropped")
+            else:
+                queued += 1
+        return queued
+
+    def open(self, app):
+        """Creates the shared HTTP session on first use."""
+        with self.lock:
+            if self.session is None:
+                self.session = Session()
+                adapter = HTTPAdapter(
+                    pool_connections=app.config["PUSH_WORKERS"],
+                    pool_maxsize=app.config["PUSH_WORKERS"],
+                )
+                self.session.mount("https://", adapter)
+                self.session.mount("http://", adapter)
+
+    def start(self, app):
+        """Starts the session and worker threads on first use."""
+        self.open(app)
+        with self.lock:
+            if self.queue is None:
+                self.queue = Queue(app.config["PUSH_QUEUE_SIZE"])
+            while len(self.workers) < app.config["PUSH_WORKERS"]:
+                worker = Thread(target=self.work, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def join(self):
+        """Blocks until every queued notification has been handled."""
+        if self.queue is not None:
+            self.queue.join()
+
+    def work(self):
+        """Worker thread loop."""
+        while True:
+            job = self.queue.get()
+            try:
+                self.deliver(*job)
+            except Exception:
+                job[0].logger.exception("Push delivery failed")
+            finally:
+                self.queue.task_done()
+
+    def deliver(self, app, subscription_id, subscription, data, retries=None):
+        """
+        Sends one notification, retrying failures with exponential backoff,
+        PUSH_RETRIES times unless retries is given.
+
+        A subscription the push service reports as expired (404 or 410)
+        is deleted instead of retried. Returns False if the notification
+        could not be delivered.
+        """
+        subscription_info = json.loads(subscription)
+        if retries is None:
+            retries = app.config["PUSH_RETRIES"]
+        for attempt in range(retries + 1):
+            try:
+                response = WebPusher(
+                    subscription_info, requests_session=self.session
+                ).send(data, headers=self.vapid.get(app, subscription_info["endpoint"]))
+            except RequestException as error:
+                status, reason = None, error
+            else:
+                status, reason = response.status_code, response.reason
+                if status <= 202:
+                    return True
+            if status in EXPIRED_STATUSES:
+                drop_subscription(app, subscription_id)
+                return True
+            if attempt == retries:
+                app.logger.warning(
+                    f"Push to subscription {subscription_id} failed: {reason}"
+                )
+                return False
+            time.sleep(app.config["PUSH_BACKOFF"] * 2 ** attempt)
+
+
+class VapidCache(object):
+    """
+    Signed VAPID headers keyed by push service audience.
+
+    Signing is ECDSA work, so headers are signed to expire after
+    VAPID_EXPIRY seconds and reused until VAPID_REFRESH seconds before
+    that. hits and misses count the lookups, VAPID_CACHE = False loads
+    the key and signs on every send.
+    """
+
+    def __init__(self):
+        self.headers = {}
+        self.keys = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, app, endpoint):
+        """Returns the VAPID headers for the push service serving endpoint."""
+        url = urlparse(endpoint)
+        audience = f"{url.scheme}://{url.netloc}"
+        private_key = app.config["VAPID_PRIVATE_KEY"]
+        key = (private_key, app.config["VAPID_CLAIMS"].get("sub"), audience)
+        now = time.time()
+        with self.lock:
+            cached = self.headers.get(key)
+            if (
+                app.config["VAPID_CACHE"]
+                and cached
+                and cached[0] - app.config["VAPID_REFRESH"] > now
+            ):
+                self.hits += 1
+                return dict(cached[1])
+            self.misses += 1
+        claims = dict(app.config["VAPID_CLAIMS"])
+        claims["aud"] = audience
+        claims["exp"] = int(now) + app.config["VAPID_EXPIRY"]
+        headers = self.vapid(private_key, app.config["VAPID_CACHE"]).sign(claims)
+        with self.lock:
+            self.headers[key] = (claims["exp"], headers)
+        return dict(headers)
+
+    def vapid(self, private_key, cache=True):
+        """Returns the loaded VAPID private key."""
+        if cache and private_key in self.keys:
+            return self.keys[private_key]
+        if os.path.isfile(private_key):
+            vapid = Vapid.from_file(private_key_file=private_key)
+        else:
+            vapid = Vapid.from_string(private_key=private_key)
+        if cache:
+            self.keys[private_key] = vapid
+        return vapid
+
+    def stats(self):
+        """Returns the hit and miss counts and the hit ratio."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0,
+        }
+
+
+def drop_subscription(app, subscription_id):
+    """
+    Deletes an expired push subscription, in a new app context
+    unless called from within one.
+    """
+    from app import db
+    from app.models import PushSubscription
+
+    with nullcontext() if has_app_context() else app.app_context():
+        PushSubscription.query.filter_by(id=subscription_id).delete()
+        db.session.commit()
+
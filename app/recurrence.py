@@ -0,0 +1,81 @@
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import Integer
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+
+class day_offset(FunctionElement):
+    """
+    Whole days between two datetime expressions (end - start).
+
+    Lets the database do the `(date - task.date).days` arithmetic
+    used to find frequency task occurrences.
+    """
+
+    type = Integer()
+    name = "day_offset"
+
+
+@compiles(day_offset)
+def compile_day_offset(element, compiler, **kw):
+    """Default (PostgreSQL style) interval arithmetic."""
+    end, start = list(element.clauses)
+    return "CAST(FLOOR(EXTRACT(EPOCH FROM ({} - {})) / 86400) AS INTEGER)".format(
+        compiler.process(end, **kw), compiler.process(start, **kw)
+    )
+
+
+@compiles(day_offset, "sqlite")
+def compile_day_offset_sqlite(element, compiler, **kw):
+    """SQLite stores datetimes as text, so compare them as epoch seconds."""
+    end, start = list(element.clauses)
+    return "((strftime('%s', {}) - strftime('%s', {})) / 86400)".format(
+        compiler.process(end, **kw), compiler.process(start, **kw)
+    )
+
+
+@compiles(day_offset, "mysql")
+def compile_day_offset_mysql(element, compiler, **kw):
+    """MySQL has a dedicated function for this."""
+    end, start = list(element.clauses)
+    return "TIMESTAMPDIFF(DAY, {}, {})".format(
+        compiler.process(start, **kw), compiler.process(end, **kw)
+    )
+
+
+def occurrence_dates(start, frequency, window_start, window_end, until=None):
+    """
+    Yields the midnight dates between window_start and window_end
+    (inclusive) on which a task starting at start recurs.
+
+    Mirrors the `(date - task.date).days % task.frequency` check,
+    so occurrences always fall after the task's own date,
+    and never after until when the series is time limited.
+    """
+    if not frequency or frequency <= 0:
+        return
+    if until is not None:
+        window_end = min(window_end, until)
+    day = max(window_start, datetime.combine(start.date(), time()))
+    offset = (day - start).days
+    if offset <= 0:
+        day += timedelta(days=1 - offset)
+        offset = 1
+    day += timedelta(days=-offset % frequency)
+    while day <= window_end:
+        yield day
+        day += timedelta(days=frequency)
+
+
+def expand_series(series, exclusions, window_start, window_end):
+    """
+    Yields (date, task) for every occurrence of the frequency tasks
+    in series, skipping (task id, date) pairs found in exclusions.
+    """
+    for task in series:
+        for day in occurrence_dates(
+            task.date, task.frequency, window_start, window_end, task.to_date
+        ):
+            if (task.id, day) not in exclusions:
+                yield day, task
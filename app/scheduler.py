@@ -0,0 +1,137 @@
+import heapq
+import time
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from itertools import count
+
+from app import db, push
+from app.models import PushSubscription, User
+
+
+Reminder = namedtuple("Reminder", ["due", "user_id", "post_id", "body"])
+
+
+class ReminderScheduler(object):
+    """
+    Sends a push notification when each task ends, replacing the
+    per-minute polling done by every open browser tab.
+
+    Upcoming task end times, recurring occurrences included, are kept
+    in a min-heap covering horizon from now. Reloading a user's
+    reminders bumps their generation, older heap entries are then
+    skipped when they reach the top rather than searched for.
+
+    Runs as `flask reminders run`. Until REMINDER_SCHEDULER is set in
+    the web app's config, open pages keep calling /check as a fallback.
+    """
+
+    def __init__(self, app=None, horizon=timedelta(days=1), poll=30):
+        self.app = app
+        self.horizon = horizon
+        self.poll = poll
+        self.heap = []
+        self.generations = {}
+        self.counter = count()
+        self.loaded_to = None
+        self.checked_at = None
+        self.fired_to = None
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, user_id, reminders):
+        """Replaces a user's scheduled reminders."""
+        generation = self.generations.get(user_id, 0) + 1
+        self.generations[user_id] = generation
+        for reminder in reminders:
+            heapq.heappush(
+                self.heap, (reminder.due, next(self.counter), generation, reminder)
+            )
+
+    def current(self, entry):
+        """Checks that a heap entry belongs to its user's latest reminders."""
+        return entry[2] == self.generations.get(entry[3].user_id)
+
+    def next_due(self):
+        """Returns the time the next reminder is due, or None."""
+        while self.heap and not self.current(self.heap[0]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """Removes and returns the current reminders due by now, earliest first."""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if self.current(entry):
+                due.append(entry[3])
+        return due
+
+    def load(self, now):
+        """
+        Loads the reminders of every user with tasks that have not been
+        fired yet, up to now + horizon.
+        """
+        self.loaded_to = now + self.horizon
+        self.checked_at = datetime.utcnow()
+        self.heap = []
+        self.generations = {}
+        user_ids = db.session.query(db.distinct(User.id)).join(User.posts)
+        for (ident,) in user_ids:
+            self.schedule(
+                ident, User.query.get(ident).reminders(self.fired_to or now, self.loaded_to)
+            )
+
+    def refresh(self, now):
+        """
+        Reloads the reminders of users whose tasks changed since the last
+        refresh, or everyone once half of the horizon has passed.
+        """
+        if self.loaded_to is None or now >= self.loaded_to - self.horizon / 2:
+            self.load(now)
+            return
+        changed = User.query.filter(User.tasks_changed >= self.checked_at)
+        self.checked_at = datetime.utcnow()
+        for user in changed:
+            self.schedule(user.id, user.reminders(self.fired_to or now, self.loaded_to))
+
+    def fire(self, now):
+        """
+        Queues a push notification for every reminder due by now.
+
+        Returns the reminders that were due.
+        """
+        due = self.pop_due(now)
+        self.fired_to = now
+        if not due:
+            return due
+        devices = defaultdict(list)
+        for device in PushSubscription.query.join(User).filter(
+            PushSubscription.user_id.in_({reminder.user_id for reminder in due}),
+            User.subscribed == True,
+        ):
+            devices[device.user_id].append(device)
+        for reminder in due:
+            push.send(self.app, devices[reminder.user_id], f"You need to {reminder.body}")
+        return due
+
+    def tick(self, now=None):
+        """Refreshes, then fires due reminders. Returns the reminders fired."""
+        if now is None:
+            now = datetime.utcnow()
+        self.refresh(now)
+        fired = self.fire(now)
+        db.session.remove()
+        return fired
+
+    def run(self):
+        """Runs the scheduler until interrupted."""
+        while True:
+            self.tick()
+            now = datetime.utcnow()
+            wake = now + timedelta(seconds=self.poll)
+            next_due = self.next_due()
+            if next_due is not None and next_due < wake:
+                wake = next_due
+            time.sleep(max((wake - now).total_seconds(), 0))
+
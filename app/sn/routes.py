@@ -1,11 +1,20 @@
 from datetime import datetime
 
-from flask import current_app, flash, redirect, render_template, request, url_for
+from flask import (
+    abort,
+    current_app,
+    flash,
+    redirect,
+    render_template,
+    request,
+    url_for,
+)
 from flask_login import current_user, login_required
 
 from app import db
 from app.email import send_email
 from app.models import Message, User
+from app.pagination import keyset_paginate
 from app.sn import bp
 from app.sn.forms import MessageForm, SearchForm, UpdateAccountForm
 
@@ -48,7 +57,6 @@ def edit_profile():
 def contacts():
     """This renders a paginated page, with all users in the db."""
     form = SearchForm()
-    page = request.args.get("page", 1, type=int)
     next_url = None
     prev_url = None
     if form.validate_on_submit():
@@ -62,13 +70,11 @@ def contacts():
         [people.append(person_email) for person_email in people_email]
         people = list(dict.fromkeys(people))
     else:
-        people = User.query.filter(User.id != current_user.id).order_by(User.username)
-        people = people.paginate(page, current_app.config["POSTS_PER_PAGE"], False)
-        if people.has_next:
-            next_url = url_for("sn.contacts", page=people.next_num)
-        if people.has_prev:
-            prev_url = url_for("sn.contacts", page=people.prev_num)
-        people = people.items
+        people, next_url, prev_url = listing_page(
+            "sn.contacts",
+            User.query.filter(User.id != current_user.id),
+            [User.username, User.id],
+        )
     return render_template(
         "sn/contacts.html",
         user=current_user,
@@ -229,19 +235,15 @@ def messages():
     """Renders a page of private receievd messages."""
     current_user.last_message_read_time = datetime.utcnow()
     db.session.commit()
-    page = request.args.get("page", 1, type=int)
-    messages = current_user.messages_received.order_by(
-        Message.timestamp.desc()
-    ).paginate(page, current_app.config["POSTS_PER_PAGE"], False)
-    next_url = (
-        url_for("sn.messages", page=messages.next_num) if messages.has_next else None
-    )
-    prev_url = (
-        url_for("sn.messages", page=messages.prev_num) if messages.has_prev else None
+    messages, next_url, prev_url = listing_page(
+        "sn.messages",
+        current_user.messages_received,
+        [Message.timestamp, Message.id],
+        descending=True,
     )
     return render_template(
         "sn/messages.html",
-        messages=messages.items,
+        messages=messages,
         next_url=next_url,
         prev_url=prev_url,
     )
@@ -253,23 +255,46 @@ def sent_messages():
     """Renders a page of paginated messages sent by the current user."""
     current_user.last_message_read_time = datetime.utcnow()
     db.session.commit()
-    page = request.args.get("page", 1, type=int)
-    sent_messages = current_user.messages_sent.order_by(
-        Message.timestamp.desc()
-    ).paginate(page, current_app.config["POSTS_PER_PAGE"], False)
-    sent_next_url = (
-        url_for("sn.sent_messages", page=sent_messages.next_num)
-        if sent_messages.has_next
-        else None
-    )
-    sent_prev_url = (
-        url_for("sn.sent_messages", page=sent_messages.prev_num)
-        if sent_messages.has_prev
-        else None
+    sent_messages, sent_next_url, sent_prev_url = listing_page(
+        "sn.sent_messages",
+        current_user.messages_sent,
+        [Message.timestamp, Message.id],
+        descending=True,
     )
     return render_template(
         "sn/sent_messages.html",
-        sent_messages=sent_messages.items,
+        sent_messages=sent_messages,
         sent_next_url=sent_next_url,
         sent_prev_url=sent_prev_url,
     )
+
+
+def listing_page(endpoint, query, keys, descending=False):
+    """
+    Reads a page of query ordered by keys after the ?cursor= of the
+    request, or by offset for old ?page= links.
+
+    Returns the items and the next and previous page urls.
+    """
+    per_page = current_app.config["POSTS_PER_PAGE"]
+    if "page" in request.args:
+        order = [key.desc() if descending else key for key in keys]
+        page = query.order_by(*order).paginate(
+            request.args.get("page", 1, type=int), per_page, False
+        )
+        return (
+            page.items,
+            url_for(endpoint, page=page.next_num) if page.has_next else None,
+            url_for(endpoint, page=page.prev_num) if page.has_prev else None,
+        )
+    try:
+        page = keyset_paginate(
+            query, keys, per_page, request.args.get("cursor"), descending
+        )
+    except ValueError:
+        abort(400)
+    return (
+        page.items,
+        url_for(endpoint, cursor=page.next_cursor) if page.next_cursor else None,
+        url_for(endpoint, cursor=page.prev_cursor) if page.prev_cursor else None,
+    )
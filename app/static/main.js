@@ -211,6 +211,14 @@ function setTime(pos, elID = null) {
 };
 
 
+if (utcOffset !== null && utcOffset !== -new Date().getTimezoneOffset()) {
+	fetch(`/timezone`, {
+		method: "POST",
+		headers: { "Content-Type": "application/json" },
+		body: JSON.stringify({ "offset": -new Date().getTimezoneOffset() })
+	});
+}
+
 if (document.getElementById("timeline")) {
 	var timeline = document.getElementById("timeline");
 	timeline.style.left = '0px';
@@ -234,9 +242,13 @@ if (document.getElementById("timeline")) {
 
 			var unlock = `${now}`
 			modal.style.display = "block";
-			fetch(`/check?id=${taskEndTimeIDs[unlock][0]}`).then(response => (
-				pushed_task = taskEndTimeIDs[unlock][0]
-			));
+			if (reminderPolling) {
+				fetch(`/check?id=${taskEndTimeIDs[unlock][0]}`).then(response => (
+					pushed_task = taskEndTimeIDs[unlock][0]
+				));
+			} else {
+				pushed_task = taskEndTimeIDs[unlock][0];
+			}
 			$('#modal-title').html(
 				`${taskEndTimeIDs[unlock][1]}`
 			);
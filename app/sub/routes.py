@@ -7,19 +7,20 @@ from flask import (
     request,
     url_for,
 )
-from flask_login import current_user
+from flask_login import current_user, login_required
 
 from app import db
 from app.sub import bp
-from app.models import User
 
 
 @bp.route("/subscribe/", methods=["GET", "POST"])
+@login_required
 def subscribe():
-    """Gets and stores a user notification subscription in the db."""
+    """Gets and stores a device's notification subscription in the db."""
     subscription = request.json.get("sub_token")
-    User.query.all()[0].subscription = json.dumps(subscription)
-    db.session.commit()
+    if subscription and subscription.get("endpoint"):
+        current_user.add_push_subscription(subscription)
+        db.session.commit()
     return redirect(url_for("sn.edit_profile"))
 
 
@@ -41,10 +42,12 @@ def subscription():
 
 
 @bp.route("/unsubscribe", methods=["GET", "POST"])
+@login_required
 def unsubscribe():
-    """turns off user notifications."""
+    """turns off user notifications and forgets the user's devices."""
     current_user.subscribed = False
     current_user.subscription = None
+    current_user.push_subscriptions.delete()
     db.session.commit()
     return redirect(url_for("main.index", date_set="ph"))
 
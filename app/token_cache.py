@@ -0,0 +1,111 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app
+
+
+class TokenCache(object):
+    """
+    An LRU of verified API tokens, mapping each to its user id and
+    expiration, so authenticated calls usually skip the token query.
+
+    Entries are trusted for TOKEN_CACHE_TTL seconds (default 60), which
+    bounds how long another process can miss a revocation, revoke_token
+    and get_token drop them from this process straight away. Holds
+    TOKEN_CACHE_SIZE (1024) tokens, TOKEN_CACHE = False disables it.
+    hits and misses count the lookups.
+    """
+
+    def __init__(self):
+        self.tokens = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, token):
+        """Returns the cached (user id, expiration) of token, or None."""
+        if not current_app.config.get("TOKEN_CACHE", True):
+            return None
+        with self.lock:
+            cached = self.tokens.get(token)
+            if cached is None or cached[2] < time.monotonic():
+                self.tokens.pop(token, None)
+                self.misses += 1
+                return None
+            self.tokens.move_to_end(token)
+            self.hits += 1
+            return cached[:2]
+
+    def add(self, token, user_id, expiration):
+        """Caches a token verified against the database."""
+        if not current_app.config.get("TOKEN_CACHE", True):
+            return
+        stale_at = time.monotonic() + current_app.config.get("TOKEN_CACHE_TTL", 60)
+        with self.lock:
+            self.tokens[token] = (user_id, expiration, stale_at)
+            self.tokens.move_to_end(token)
+            while len(self.tokens) > current_app.config.get("TOKEN_CACHE_SIZE", 1024):
+                self.tokens.popitem(last=False)
+
+    def invalidate(self, token):
+        """Drops a revoked or replaced token."""
+        with self.lock:
+            self.tokens.pop(token, None)
+
+    def stats(self):
+        """Returns the hit and miss counts, the hit ratio and the size."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0,
+            "size": len(self.tokens),
+        }
+
+
+class DenyList(object):
+    """
+    The ids of revoked signed access tokens that have not expired.
+
+    Reloaded from the DeniedToken table at most every
+    JWT_DENY_LIST_REFRESH seconds (default 30), so verifying a token
+    does not query on every call. Tokens denied in this process apply
+    straight away. Access tokens are short lived, so the list stays small.
+    """
+
+    def __init__(self):
+        self.tokens = set()
+        self.loaded_at = None
+        self.lock = Lock()
+
+    def denied(self, jti):
+        """Checks whether the access token with id jti was revoked."""
+        refresh = current_app.config.get("JWT_DENY_LIST_REFRESH", 30)
+        if self.loaded_at is None or self.loaded_at + refresh < time.monotonic():
+            self.load()
+        return jti in self.tokens
+
+    def load(self):
+        """Replaces the list with the unexpired rows of DeniedToken."""
+        from datetime import datetime
+
+        from app import db
+        from app.models import DeniedToken
+
+        rows = db.session.query(DeniedToken.jti).filter(
+            DeniedToken.expires >= datetime.utcnow()
+        )
+        tokens = {jti for (jti,) in rows}
+        with self.lock:
+            self.tokens = tokens
+            self.loaded_at = time.monotonic()
+
+    def add(self, jti):
+        """Denies a token in this process straight away."""
+        with self.lock:
+            self.tokens.add(jti)
+
+
+token_cache = TokenCache()
+deny_list = DenyList()
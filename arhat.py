@@ -1,8 +1,9 @@
 from app.models import User, Post
 
-from app import create_app, db
+from app import cli, create_app, db
 
 app = create_app()
+cli.register(app)
 
 @app.shell_context_processor
 def make_shell_context():
@@ -0,0 +1,37 @@
+"""
+Performance benchmarks, run from the repository root, for example
+
+    python -m benchmarks.reminders --count 100000
+
+They are kept out of the app, anything that needs a database builds
+its own app on an in-memory one rather than using the configured one.
+"""
+from contextlib import contextmanager
+
+from sqlalchemy.pool import StaticPool
+
+from app import create_app, db
+from config import Config
+
+
+class BenchmarkConfig(Config):
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "poolclass": StaticPool,
+        "connect_args": {"check_same_thread": False},
+    }
+    SERVER_NAME = "localhost.localdomain:5000"
+    WTF_CSRF_ENABLED = False
+
+
+@contextmanager
+def throwaway_app():
+    """Yields an app with the tables created on an empty in-memory database."""
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        try:
+            yield app
+        finally:
+            db.session.remove()
+            db.drop_all()
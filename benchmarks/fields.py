@@ -0,0 +1,85 @@
+import time
+from datetime import datetime, timedelta
+
+import click
+
+from app import db
+from app.models import Message, Post, User
+from benchmarks import throwaway_app
+
+
+MOBILE_SCREENS = (
+    ("contacts", "/api/users/{id}/followed", "id,username,image_url"),
+    ("inbox", "/api/messages/received/{id}", "id,body,sender_id,timestamp"),
+    ("day", "/api/tasks/{id}/{today}", "id,body,start_time,end_time,color,done"),
+)
+
+
+def seed(contacts=100, messages=500, tasks=20):
+    """Adds a user following contacts, with an inbox and a day of tasks."""
+    user = User(username="benchmark", email="benchmark@example.com")
+    db.session.add(user)
+    for position in range(contacts):
+        contact = User(username=f"contact{position}", email=f"contact{position}@example.com")
+        db.session.add(contact)
+        user.follow(contact)
+    db.session.flush()
+    today = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+    db.session.add_all(
+        Message(sender_id=user.id, recipient_id=user.id, body="benchmark " * 10,
+                timestamp=today - timedelta(minutes=position))
+        for position in range(messages)
+    )
+    db.session.add_all(
+        Post(body="benchmark", date=today, user_id=user.id, color="#ffffff",
+             start_time=position * 60, end_time=position * 60 + 30)
+        for position in range(tasks)
+    )
+    db.session.commit()
+    return user
+
+
+def benchmark(app, user, repeat=20):
+    """
+    Requests the API calls behind the mobile screens as user, in full
+    and with the fields the screens show.
+
+    Returns (screen, full bytes, full ms, sparse bytes, sparse ms) per screen.
+    """
+    client = app.test_client()
+    headers = {"Authorization": f"Bearer {user.get_token()}"}
+    db.session.commit()
+    user_id = user.id
+    today = datetime.strftime(datetime.utcnow(), "%d-%m-%Y")
+    results = []
+    for screen, url, fields in MOBILE_SCREENS:
+        url = url.format(id=user_id, today=today)
+        timings = []
+        for query_string in ({}, {"fields": fields}):
+            began = time.perf_counter()
+            for _ in range(repeat):
+                response = client.get(url, headers=headers, query_string=query_string,
+                                      buffered=True)
+            timings.append((len(response.data),
+                            (time.perf_counter() - began) / repeat * 1000))
+        results.append((screen,) + timings[0] + timings[1])
+    return results
+
+
+@click.command()
+@click.option("--contacts", default=100, help="Users the benchmark user follows.")
+@click.option("--messages", default=500, help="Messages in the benchmark user's inbox.")
+@click.option("--repeat", default=20, help="Requests for each call.")
+def main(contacts, messages, repeat):
+    """Compare full and sparse fieldset responses for the mobile screens."""
+    with throwaway_app() as app:
+        results = benchmark(app, seed(contacts, messages), repeat)
+    for screen, full_bytes, full_ms, sparse_bytes, sparse_ms in results:
+        click.echo(
+            f"{screen}: full {full_bytes} bytes {full_ms:.1f}ms, "
+            f"fields {sparse_bytes} bytes {sparse_ms:.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
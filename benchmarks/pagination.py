@@ -0,0 +1,65 @@
+import time
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app.models import Message
+from app.pagination import NEXT, encode_cursor, keyset_paginate
+
+
+def benchmark(messages=1000000, per_page=25, depths=(1, 100, 1000, 10000, 39000)):
+    """
+    Times reading pages of a messages inbox at increasing depths with
+    paginate style OFFSET and COUNT(*) queries, then with a cursor.
+
+    Runs against an in-memory SQLite database holding one user's inbox.
+    Returns (page, offset ms, keyset ms) for each depth.
+    """
+    engine = create_engine("sqlite://")
+    Message.__table__.create(engine)
+    start = datetime(2020, 1, 1)
+    with engine.begin() as conn:
+        for batch in range(0, messages, 50000):
+            conn.execute(Message.__table__.insert(), [
+                {"sender_id": 2, "recipient_id": 1, "body": "benchmark",
+                 "timestamp": start + timedelta(seconds=position // 3)}
+                for position in range(batch, min(batch + 50000, messages))
+            ])
+    session = Session(bind=engine)
+    inbox = session.query(Message).filter(Message.recipient_id == 1)
+    keys = [Message.timestamp, Message.id]
+    results = []
+    for page in depths:
+        offset = (page - 1) * per_page
+        if offset >= messages:
+            break
+        began = time.perf_counter()
+        inbox.order_by(Message.timestamp.desc(), Message.id.desc()).limit(
+            per_page).offset(offset).all()
+        inbox.order_by(None).count()
+        offset_ms = (time.perf_counter() - began) * 1000
+        cursor = None
+        if offset:
+            last = inbox.order_by(Message.timestamp.desc(), Message.id.desc()).offset(
+                offset - 1).first()
+            cursor = encode_cursor(NEXT, [last.timestamp, last.id])
+        began = time.perf_counter()
+        keyset_paginate(inbox, keys, per_page, cursor, descending=True)
+        results.append((page, offset_ms, (time.perf_counter() - began) * 1000))
+    session.close()
+    return results
+
+
+@click.command()
+@click.option("--count", default=1000000, help="Number of messages in the inbox.")
+@click.option("--per-page", default=25, help="Messages per page.")
+def main(count, per_page):
+    """Compare offset and cursor paging deep into a large inbox."""
+    for page, offset_ms, keyset_ms in benchmark(count, per_page):
+        click.echo(f"page {page}: offset {offset_ms:.1f}ms, cursor {keyset_ms:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import json
+import os
+import time
+from base64 import urlsafe_b64encode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import click
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from requests import Session
+
+from app.push import PushQueue
+from benchmarks import throwaway_app
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """A local push service that accepts every notification."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def b64(data):
+    """Unpadded urlsafe base64, as used by push subscriptions and VAPID keys."""
+    return urlsafe_b64encode(data).strip(b"=").decode()
+
+
+def benchmark(app, sends=200):
+    """
+    Times sends to a local stand-in push service, first signing the
+    VAPID headers for every send, then with the VapidCache.
+
+    Returns sends per second (uncached, cached) and the cache stats.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    device = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    subscription = json.dumps(
+        {
+            "endpoint": f"http://127.0.0.1:{server.server_port}/push",
+            "keys": {
+                "p256dh": b64(
+                    device.public_key().public_bytes(
+                        serialization.Encoding.X962,
+                        serialization.PublicFormat.UncompressedPoint,
+                    )
+                ),
+                "auth": b64(os.urandom(16)),
+            },
+        }
+    )
+    config = dict(app.config)
+    if not app.config["VAPID_PRIVATE_KEY"]:
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        app.config["VAPID_PRIVATE_KEY"] = b64(
+            key.private_numbers().private_value.to_bytes(32, "big")
+        )
+    queue = PushQueue()
+    queue.session = Session()
+    rates = []
+    try:
+        for cache in (False, True):
+            app.config["VAPID_CACHE"] = cache
+            began = time.perf_counter()
+            for _ in range(sends):
+                queue.deliver(app, None, subscription, "benchmark")
+            rates.append(sends / (time.perf_counter() - began))
+    finally:
+        app.config.update(config)
+        server.shutdown()
+        server.server_close()
+    return rates[0], rates[1], queue.vapid.stats()
+
+
+@click.command()
+@click.option("--sends", default=200, help="Number of sends for each run.")
+def main(sends):
+    """Time sends to a local push service with and without the VAPID cache."""
+    with throwaway_app() as app:
+        uncached, cached, stats = benchmark(app, sends)
+    click.echo(f"Signing every send: {uncached:.0f} sends/s.")
+    click.echo(f"Cached VAPID headers: {cached:.0f} sends/s.")
+    click.echo(f"Cache hits {stats['hits']}, misses {stats['misses']}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import time
+from datetime import datetime, timedelta
+
+import click
+
+from app.scheduler import Reminder, ReminderScheduler
+
+
+def benchmark(reminders=100000, users=1000):
+    """
+    Times scheduling then firing reminders spread over a day for users.
+
+    Returns (schedule seconds, fire seconds).
+    """
+    scheduler = ReminderScheduler()
+    start = datetime(2020, 1, 1)
+    per_user = {}
+    for position in range(reminders):
+        user_id = position % users
+        due = start + timedelta(minutes=(position * 7919) % 1440)
+        per_user.setdefault(user_id, []).append(
+            Reminder(due, user_id, position, "benchmark")
+        )
+    began = time.perf_counter()
+    for user_id, user_reminders in per_user.items():
+        scheduler.schedule(user_id, user_reminders)
+    scheduled = time.perf_counter()
+    for minute in range(1440):
+        scheduler.pop_due(start + timedelta(minutes=minute))
+    finished = time.perf_counter()
+    return scheduled - began, finished - scheduled
+
+
+@click.command()
+@click.option("--count", default=100000, help="Number of reminders.")
+@click.option("--users", default=1000, help="Number of users they belong to.")
+def main(count, users):
+    """Time scheduling and firing reminders."""
+    scheduled, fired = benchmark(count, users)
+    click.echo(f"Scheduled {count} reminders in {scheduled:.3f}s ({count / scheduled:.0f}/s).")
+    click.echo(f"Fired {count} reminders in {fired:.3f}s ({count / fired:.0f}/s).")
+
+
+if __name__ == "__main__":
+    main()
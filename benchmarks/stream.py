@@ -0,0 +1,69 @@
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import click
+from flask import json
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app.api.stream import generate
+from app.models import Message, PaginatedAPIMixin
+
+
+def benchmark(sizes=(1000, 10000, 100000)):
+    """
+    Measures the peak memory of serializing inboxes of each size as one
+    list, the way to_collection_dict does, then by streaming.
+
+    Runs against an in-memory SQLite database. Returns (messages,
+    list peak KiB, list seconds, stream peak KiB, stream seconds) per size.
+    """
+    results = []
+    for size in sizes:
+        engine = create_engine("sqlite://")
+        Message.__table__.create(engine)
+        start = datetime(2020, 1, 1)
+        with engine.begin() as conn:
+            conn.execute(Message.__table__.insert(), [
+                {"sender_id": 2, "recipient_id": 1, "body": "benchmark " * 10,
+                 "timestamp": start + timedelta(seconds=position)}
+                for position in range(size)
+            ])
+        measured = []
+        for streaming in (False, True):
+            session = Session(bind=engine)
+            inbox = session.query(Message).filter(Message.recipient_id == 1)
+            tracemalloc.start()
+            began = time.perf_counter()
+            if streaming:
+                for chunk in generate(inbox):
+                    pass
+            else:
+                json.dumps(PaginatedAPIMixin.to_collection_dict(inbox, None, None, None))
+            seconds = time.perf_counter() - began
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            session.close()
+            measured += [peak / 1024, seconds]
+        engine.dispose()
+        results.append((size,) + tuple(measured))
+    return results
+
+
+@click.command()
+@click.option(
+    "--messages", "sizes", multiple=True, type=int, default=(1000, 10000, 100000),
+    help="Inbox sizes to serialize, repeatable.",
+)
+def main(sizes):
+    """Compare the peak memory of listing and streaming an inbox."""
+    for size, list_kib, list_s, stream_kib, stream_s in benchmark(sizes):
+        click.echo(
+            f"{size} messages: list {list_kib:.0f}KiB {list_s:.2f}s, "
+            f"stream {stream_kib:.0f}KiB {stream_s:.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
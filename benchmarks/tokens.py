@@ -0,0 +1,70 @@
+import time
+from threading import Thread
+
+import click
+
+from app import db
+from app.models import User
+from benchmarks import throwaway_app
+
+
+def benchmark(app, user, requests=500):
+    """
+    Times authenticated calls to GET /api/tokens/cache as user with an
+    opaque token checked against the database every call, then through
+    the TokenCache, then with a signed access token.
+
+    Returns requests per second (database, cached, signed).
+    """
+    client = app.test_client()
+    opaque = user.get_token()
+    signed = user.get_access_token()
+    db.session.commit()
+    cache = app.config.get("TOKEN_CACHE", True)
+    rates = []
+    try:
+        for token, cached in ((opaque, False), (opaque, True), (signed, True)):
+            app.config["TOKEN_CACHE"] = cached
+            headers = {"Authorization": f"Bearer {token}"}
+            rates.append(rate(client, headers, requests))
+    finally:
+        app.config["TOKEN_CACHE"] = cache
+    return tuple(rates)
+
+
+def rate(client, headers, requests):
+    """
+    Requests per second of GET /api/tokens/cache, sent from another
+    thread so that each request gets its own app context and session,
+    as under a server, rather than reusing the caller's.
+    """
+    elapsed = []
+
+    def run():
+        began = time.perf_counter()
+        for _ in range(requests):
+            client.get("/api/tokens/cache", headers=headers)
+        elapsed.append(time.perf_counter() - began)
+
+    thread = Thread(target=run)
+    thread.start()
+    thread.join()
+    return requests / elapsed[0]
+
+
+@click.command()
+@click.option("--requests", default=500, help="Requests for each mode.")
+def main(requests):
+    """Compare authenticated throughput of the API token modes."""
+    with throwaway_app() as app:
+        user = User(username="benchmark", email="benchmark@example.com")
+        db.session.add(user)
+        db.session.commit()
+        database, cached, signed = benchmark(app, user, requests)
+    click.echo(f"Opaque token, checked in the database: {database:.0f} requests/s.")
+    click.echo(f"Opaque token, token cache: {cached:.0f} requests/s.")
+    click.echo(f"Signed access token: {signed:.0f} requests/s.")
+
+
+if __name__ == "__main__":
+    main()
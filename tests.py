@@ -1,10 +1,52 @@
 from datetime import datetime, timedelta
 
+import base64
+
 import json
 
+import re
+
+import tempfile
+
+import time
+
 import unittest
 
-from app.models import User, Post, Message
+from contextlib import contextmanager
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+
+from threading import Event, Thread
+
+from cryptography.hazmat.backends import default_backend
+
+from cryptography.hazmat.primitives import serialization
+
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from py_vapid.utils import b64urlencode
+
+from click.testing import CliRunner
+
+from flask_mail import Message as EmailMessage
+
+from sqlalchemy import event
+
+from sqlalchemy.pool import StaticPool
+
+from app.models import (
+    DailyCompletion,
+    DeniedToken,
+    Message,
+    Outbox,
+    Post,
+    PushSubscription,
+    RefreshToken,
+    TaskOccurrence,
+    User,
+)
 
 from app.auth.forms import LoginForm, RegistrationForm
 
@@ -17,7 +59,35 @@ from app.main.routes import (
     convert_date_format
 )
 
-from app import create_app, db
+from app import cli, create_app, db, mail, push
+
+from app.depression import check_all_users, eligible_user_ids, run_depression_check
+
+from app.email import MailQueue, mail_queue, send_email
+
+from app.images import image_cache, image_digest, image_path
+
+from app.outbox import deliver_batch, run_worker
+
+from app.pagination import encode_cursor
+
+from app.push import VapidCache
+
+from app.scheduler import ReminderScheduler
+
+from app.token_cache import token_cache
+
+from benchmarks import fields as fields_benchmark
+
+from benchmarks import pagination as pagination_benchmark
+
+from benchmarks import push as push_benchmark
+
+from benchmarks import reminders as reminders_benchmark
+
+from benchmarks import stream as stream_benchmark
+
+from benchmarks import tokens as tokens_benchmark
 
 
 from config import Config
@@ -29,6 +99,182 @@ class TestConfig(Config):
     SERVER_NAME = "localhost.localdomain:5000"
     _external = False
     WTF_CSRF_ENABLED = False
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "poolclass": StaticPool,
+        "connect_args": {"check_same_thread": False},
+    }
+    PUSH_BACKOFF = 0
+    OUTBOX_BACKOFF = 0
+
+
+class PushEndpoint(object):
+    """
+    Local stand-in for a push service.
+
+    Answers each push with the next of statuses (201 once they run out)
+    and records the requests it received.
+    """
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.requests = []
+        self.connections = set()
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                endpoint.requests.append(
+                    (self.path, {k.lower(): v for k, v in self.headers.items()}, body)
+                )
+                endpoint.connections.add(self.client_address)
+                self.send_response(endpoint.statuses.pop(0) if endpoint.statuses else 201)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def subscription(self, path="/push"):
+        """Returns a browser style subscription for path."""
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        p256dh = key.public_key().public_bytes(
+            serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+        )
+        return {
+            "endpoint": f"http://127.0.0.1:{self.server.server_port}{path}",
+            "keys": {
+                "p256dh": b64urlencode(p256dh),
+                "auth": b64urlencode(b"0123456789abcdef"),
+            },
+        }
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class QueryCounter(object):
+    """
+    Records the SQL statements run against the test database.
+
+    Used as a context manager so that tests can assert a maximum
+    number of queries and check that queries use an index.
+    """
+
+    scanned_tables = (
+        "post",
+        "message",
+        "task_occurrence",
+        "daily_completion",
+        "followers",
+        "penders",
+        "push_subscription",
+    )
+
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(db.engine, "before_cursor_execute", self.record)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(db.engine, "before_cursor_execute", self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        """Keeps each statement and its parameters."""
+        self.statements.append((statement, parameters))
+
+    @property
+    def count(self):
+        """The number of statements run."""
+        return len(self.statements)
+
+    def full_scans(self):
+        """
+        Returns the EXPLAIN QUERY PLAN details of every recorded
+        SELECT that scans one of scanned_tables without an index.
+        """
+        pattern = re.compile(
+            r"SCAN (TABLE )?({})\b".format("|".join(self.scanned_tables))
+        )
+        scans = []
+        for statement, parameters in self.statements:
+            if not statement.lstrip().upper().startswith("SELECT"):
+                continue
+            plan = db.engine.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            for row in plan:
+                if pattern.match(row[-1]) and "INDEX" not in row[-1]:
+                    scans.append(row[-1])
+        return scans
+
+
+class SMTPStandIn(object):
+    """
+    Local stand-in SMTP server.
+
+    Records the messages it receives and the connections made, and
+    holds back its greeting until gate is set.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+        self.gate = Event()
+        self.gate.set()
+        stand_in = self
+
+        class Handler(StreamRequestHandler):
+            def handle(self):
+                stand_in.connections += 1
+                stand_in.gate.wait(5)
+                self.reply("220 localhost stand-in")
+                for line in self.rfile:
+                    command = line.decode().strip().upper()
+                    if command == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        data = []
+                        for line in self.rfile:
+                            if line == b".\r\n":
+                                break
+                            data.append(line)
+                        stand_in.messages.append(b"".join(data))
+                        self.reply("250 OK")
+                    elif command == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    else:
+                        self.reply("250 OK")
+
+            def reply(self, text):
+                self.wfile.write((text + "\r\n").encode())
+
+        self.server = ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def configure(self, app):
+        """Points app's mail at the stand-in."""
+        app.config.update(
+            MAIL_SERVER="127.0.0.1",
+            MAIL_PORT=self.server.server_address[1],
+            MAIL_USE_TLS=False,
+            MAIL_USE_SSL=False,
+            MAIL_USERNAME=None,
+            MAIL_PASSWORD=None,
+            MAIL_SUPPRESS_SEND=False,
+        )
+        mail.init_app(app)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
 
 
 class UserModelCase(unittest.TestCase):
@@ -222,21 +468,24 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(set_date("01-01-2001"), date_object)
 
     def test_check_if_depression_sent_date(self):
-        """checks that with a sent date depression_check will not be run."""
-        u1 = User(username="john", email="john@example.com")
+        """checks that with a sent date of today depression_check will not be run."""
+        u1 = User(username="john", email="john@example.com", threshold=50, days=7)
         db.session.add(u1)
         db.session.commit()
 
-        self.assertIsNone(u1.check_if_depression_sent(date))
+        self.assertEqual(eligible_user_ids(date), [u1.id])
+        u1.sent_date = date
+        db.session.commit()
+        self.assertEqual(eligible_user_ids(date), [])
 
-    def test_check_if_depression_sent_date(self):
+    def test_check_if_depression_unset(self):
         """checks that without threshold or days depression_check won't run."""
-        u1 = User(username="john", email="john@example.com")
-        db.session.add(u1)
-        u1.sent_date = date
+        db.session.add(User(username="john", email="john@example.com"))
+        db.session.add(User(username="susan", email="susan@example.com", threshold=50))
+        db.session.add(User(username="mark", email="mark@example.com", days=7))
         db.session.commit()
 
-        self.assertIsNone(u1.check_if_depression_sent(date))
+        self.assertEqual(eligible_user_ids(date), [])
 
     def test_login_page(self):
         """This tests login page renders correctly."""
@@ -747,6 +996,1245 @@ class UserModelCase(unittest.TestCase):
             b"this is an edited single event of a time limited freq task", response.data
         )
 
+    def test_frequency_tasks_for_date(self):
+        """Tests that recurring tasks are found by the database on the right days."""
+        u1, u2 = user_creation_helper(self)
+        start = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        task = Post(body="every other day", date=start, user_id=u1.id, frequency=2)
+        db.session.add(task)
+        db.session.commit()
+        child = Post(
+            body="moved", date=start + timedelta(days=4), user_id=u1.id, exclude=task.id
+        )
+        db.session.add(child)
+        db.session.commit()
+
+        self.assertEqual(u1.frequency_tasks_for_date(start).all(), [])
+        self.assertEqual(
+            u1.frequency_tasks_for_date(start + timedelta(days=1)).all(), []
+        )
+        self.assertEqual(
+            u1.frequency_tasks_for_date(start + timedelta(days=2)).all(), [task]
+        )
+        self.assertEqual(
+            u1.frequency_tasks_for_date(start + timedelta(days=4)).all(), []
+        )
+        self.assertEqual(u2.frequency_tasks_for_date(start + timedelta(days=2)).all(), [])
+
+    def test_task_occurrences_match_recurrence_query(self):
+        """Tests that the occurrence index holds the same tasks as the recurrence query."""
+        u1, u2 = user_creation_helper(self)
+        start = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        for frequency in (1, 3, 7):
+            db.session.add(
+                Post(body="recurring", date=start, user_id=u1.id, frequency=frequency)
+            )
+        db.session.commit()
+        parent = Post.query.first()
+        db.session.add(
+            Post(body="moved", date=start + timedelta(days=2), user_id=u1.id, exclude=parent.id)
+        )
+        u1.rebuild_occurrences()
+        db.session.commit()
+
+        for offset in range(30):
+            day = start + timedelta(days=offset)
+            self.assertTrue(u1.occurrences_cover(day))
+            self.assertEqual(
+                u1.tasks_for_date(day)[1], u1.frequency_tasks_for_date(day).all()
+            )
+
+    def test_task_occurrences_synced_from_form(self):
+        """Tests that a frequency task created and edited from the form is indexed."""
+        tester = self.app.test_client()
+        login_helper(self, tester)
+        form, _ = new_task_with_form_helper(self, tester)
+        form = form_helper(1, form, tester)
+        u1 = User.query.filter_by(username="dave").first()
+        start = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+
+        self.assertEqual(
+            TaskOccurrence.query.filter_by(
+                user_id=u1.id, date=start + timedelta(days=1)
+            ).count(),
+            1,
+        )
+
+    def test_rebuild_occurrences_command(self):
+        """Tests that the cli command backfills the occurrence index."""
+        u1, u2 = user_creation_helper(self)
+        start = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        db.session.add(Post(body="daily", date=start, user_id=u1.id, frequency=1))
+        db.session.commit()
+        ident = u1.id
+        cli.register(self.app)
+
+        result = self.app.test_cli_runner().invoke(args=["occurrences", "rebuild"])
+
+        self.assertIn("2 users", result.output)
+        self.assertEqual(TaskOccurrence.query.filter_by(user_id=ident).count(), 90)
+
+    def test_api_tasks_in_range(self):
+        """Tests that the range endpoint matches the single day endpoint for each day."""
+        tester = self.app.test_client()
+        u1, headers = api_user_helper(self)
+        start = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        db.session.add_all(
+            [
+                Post(body="every day", date=start, user_id=u1.id, frequency=1),
+                Post(body="one off", date=start + timedelta(days=1), user_id=u1.id),
+                Post(body="done", date=start, user_id=u1.id, done=True),
+            ]
+        )
+        db.session.commit()
+        day_from = datetime.strftime(start, "%d-%m-%Y")
+
+        response = tester.get(
+            f"/api/tasks/{u1.id}?from={day_from}&to={tomorrow}", headers=headers
+        )
+        data = json.loads(response.data)
+
+        self.assertEqual(sorted(data["days"]), sorted([day_from, tomorrow]))
+        self.assertEqual(len(data["days"][tomorrow]["items"]), 2)
+        for day, tasks in data["days"].items():
+            single = json.loads(
+                tester.get(f"/api/tasks/{u1.id}/{day}", headers=headers).data
+            )
+            self.assertEqual(tasks["items"], single["items"])
+
+    def test_api_tasks_in_range_bad_request(self):
+        """Tests that a missing or reversed range is rejected."""
+        tester = self.app.test_client()
+        u1, headers = api_user_helper(self)
+
+        response = tester.get(f"/api/tasks/{u1.id}?from={tomorrow}", headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+        response = tester.get(
+            f"/api/tasks/{u1.id}?from={tomorrow}&to={yesterday}", headers=headers
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_depression_check_engine(self):
+        """Tests the per day and period percentages of the depression check."""
+        u1, u2 = user_creation_helper(self)
+        u1.days = 3
+        today = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        series = Post(
+            body="daily", date=today - timedelta(days=5), user_id=u1.id, frequency=1
+        )
+        db.session.add(series)
+        db.session.commit()
+        db.session.add_all(
+            [
+                Post(body="a", date=today - timedelta(days=1), user_id=u1.id, done=True),
+                Post(body="b", date=today - timedelta(days=1), user_id=u1.id),
+                Post(
+                    body="moved",
+                    date=today - timedelta(days=3),
+                    user_id=u1.id,
+                    done=True,
+                    exclude=series.id,
+                ),
+            ]
+        )
+        db.session.commit()
+
+        result = run_depression_check(u1, today.date())
+
+        self.assertEqual(
+            [(day.due, day.done) for day in result.days], [(1, 1), (1, 0), (3, 1)]
+        )
+        self.assertEqual([day.percentage for day in result.days][:2], [100, 0])
+        self.assertAlmostEqual(result.period_percentage, (100 + 0 + 100 / 3) / 3)
+        self.assertTrue(result.below(50))
+
+    def test_depression_check_engine_without_tasks(self):
+        """Tests that a period without due tasks counts as complete."""
+        u1, u2 = user_creation_helper(self)
+        u1.days = 7
+
+        result = run_depression_check(u1)
+
+        self.assertEqual(result.period_percentage, 100)
+        self.assertEqual(len(result.days), 7)
+
+    def test_depression_check_batch(self):
+        """Tests that the batch check alerts followed users and records sent dates once."""
+        u1, u2 = user_creation_helper(self)
+        u3 = User(username="mark", email="mark@example.com", threshold=50, days=2)
+        u1.threshold = 50
+        u1.days = 2
+        u1.follow(u2)
+        yesterday_date = datetime.strptime(date, "%Y-%m-%d %H:%M:%S") - timedelta(days=1)
+        db.session.add_all([u3, Post(body="missed", date=yesterday_date, user_id=u1.id)])
+        db.session.commit()
+        ident, followed = u1.id, u2.id
+        cli.register(self.app)
+
+        result = self.app.test_cli_runner().invoke(args=["depression", "check"])
+
+        self.assertIn("Checked 2 users", result.output)
+        self.assertEqual(Message.query.filter_by(recipient_id=followed).count(), 1)
+        self.assertEqual(User.query.get(ident).sent_date, date)
+        self.assertEqual(check_all_users(), [])
+
+    def test_depression_check_processes(self):
+        """Tests that pool processes check users in the calling app's database."""
+        with tempfile.TemporaryDirectory() as directory:
+
+            class FileConfig(TestConfig):
+                SQLALCHEMY_DATABASE_URI = f"sqlite:///{directory}/arhat.db"
+                SQLALCHEMY_ENGINE_OPTIONS = {}
+
+            db.session.remove()
+            with create_app(FileConfig).app_context():
+                db.create_all()
+                db.session.add_all(
+                    User(username=f"user{n}", email=f"{n}@example.com", threshold=50, days=2)
+                    for n in range(4)
+                )
+                db.session.commit()
+
+                checked = check_all_users(processes=2)
+                sent = [user.sent_date for user in User.query]
+                db.session.remove()
+
+        self.assertEqual(sorted(checked), [1, 2, 3, 4])
+        self.assertEqual(sent, [date] * 4)
+
+    def test_daily_completion_rollup_maintained(self):
+        """Tests that the rollup matches a recount after tasks are added, edited and completed."""
+        tester = self.app.test_client()
+        login_helper(self, tester)
+        add_and_edit_task_helper(self, 2)
+        u1 = User.query.filter_by(username="dave").first()
+        u1.rebuild_completion()
+        db.session.commit()
+        form, converted_response_data = new_task_with_form_helper(self, tester)
+        form_helper(3, form, tester)
+        new_time_limited_task_helper(self, tester)
+        tester.get(f"/complete?id={converted_response_data['id']}")
+        u1 = User.query.filter_by(username="dave").first()
+        today = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+
+        self.assertEqual(u1.completion_mismatches(), [])
+        self.assertEqual(u1.completion_counts(today, today), {today: [4, 1]})
+
+    def test_daily_completion_check_command(self):
+        """Tests that the check command reports a rollup that has drifted."""
+        u1, u2 = user_creation_helper(self)
+        today = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        u1.rebuild_completion()
+        db.session.add(Post(body="added behind the rollup", date=today, user_id=u1.id))
+        db.session.commit()
+        cli.register(self.app)
+        runner = self.app.test_cli_runner()
+
+        result = runner.invoke(args=["completion", "check"])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("1 mismatched days", result.output)
+
+        runner.invoke(args=["completion", "rebuild"])
+        result = runner.invoke(args=["completion", "check"])
+        self.assertEqual(result.exit_code, 0)
+
+    def test_daily_completion_updates_only_affected_days(self):
+        """Tests that completing a task recounts its day only and reads never write."""
+        tester = self.app.test_client()
+        login_helper(self, tester)
+        u1 = User.query.filter_by(username="dave").first()
+        today = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        yesterday = today - timedelta(days=1)
+        daily = Post(
+            body="daily", date=today - timedelta(days=5), user_id=u1.id, frequency=1,
+            start_time=60, end_time=120, done=False,
+        )
+        db.session.add(daily)
+        db.session.flush()
+        u1.rebuild_completion(today)
+        db.session.add(Post(body="added behind the rollup", date=yesterday, user_id=u1.id))
+        db.session.commit()
+
+        tester.get(f"/complete?id={daily.id}")
+        u1 = User.query.filter_by(username="dave").first()
+
+        self.assertEqual([day for day, _, _ in u1.completion_mismatches()], [yesterday])
+        self.assertEqual(u1.completion_counts(today, today), {today: [1, 1]})
+
+        u2, headers = api_user_helper(self)
+        response = tester.get(
+            f"/api/users/{u2.id}/completion?from=01-01-2020&to=02-01-2020", headers=headers
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(User.query.get(u2.id).completion_to)
+        self.assertEqual(DailyCompletion.query.filter_by(user_id=u2.id).count(), 0)
+
+    def test_threshold_alert_fan_out(self):
+        """Tests that every followed user gets one message and one email a day."""
+        u1, u2 = user_creation_helper(self)
+        u3 = User(username="mark", email="mark@example.com")
+        db.session.add(u3)
+        u1.threshold = 50
+        u1.follow(u2)
+        u1.follow(u3)
+        db.session.commit()
+
+        alerted = u1.check_percentage_against_threshold(10)
+        self.assertEqual(u1.check_percentage_against_threshold(10), [])
+        with mail.record_messages() as outbox:
+            run_worker(self.app, once=True)
+
+        self.assertEqual(sorted(alerted), ["mark@example.com", "susan@example.com"])
+        self.assertEqual(sorted(msg.recipients[0] for msg in outbox), sorted(alerted))
+        self.assertEqual(u1.messages_sent.count(), 2)
+        self.assertEqual(u1.check_percentage_against_threshold(60), [])
+
+    def test_api_create_task_series(self):
+        """Tests that a repeating api task with a to date is stored as a single rule."""
+        tester = self.app.test_client()
+        u1, headers = api_user_helper(self)
+        start = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        to_date = datetime.strftime(start + timedelta(days=6), "%d-%m-%Y")
+        payload = {
+            "body": "every other day",
+            "start_time": 60,
+            "end_time": 120,
+            "frequency": 2,
+            "to_date": to_date,
+            "color": "#fff",
+        }
+
+        tester.post(
+            f"/api/tasks/{u1.id}/{datetime.strftime(start, '%d-%m-%Y')}",
+            json=payload,
+            headers=headers,
+        )
+        tasks = Post.query.all()
+        days = u1.get_tasks_in_range(start, start + timedelta(days=8))
+
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(tasks[0].frequency, 2)
+        self.assertEqual(tasks[0].to_date, start + timedelta(days=6))
+        self.assertEqual(
+            [day for day, tasks in sorted(days.items()) if tasks],
+            [start + timedelta(days=offset) for offset in (0, 2, 4, 6)],
+        )
+
+    def test_api_time_limited_series_frequency(self):
+        """Tests that a time limited series reports a null frequency, and keeps it when sent back."""
+        tester = self.app.test_client()
+        u1, headers = api_user_helper(self)
+        start = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        series = Post(
+            body="every other day", date=start, to_date=start + timedelta(days=6),
+            user_id=u1.id, frequency=2, start_time=60, end_time=120, done=False,
+        )
+        db.session.add(series)
+        db.session.commit()
+
+        response = tester.get(f"/api/tasks/{u1.id}/{start:%d-%m-%Y}", headers=headers)
+        (item,) = response.get_json()["items"]
+        self.assertIsNone(item["frequency"])
+
+        item.update(single_event=False, body="renamed")
+        tester.put(f"/api/tasks/{series.id}", json=item, headers=headers)
+        series = Post.query.get(series.id)
+        self.assertEqual((series.body, series.frequency), ("renamed", 2))
+
+    def test_api_update_task_series(self):
+        """Tests that editing a whole series applies the frequency done rule to each task."""
+        tester = self.app.test_client()
+        u1, headers = api_user_helper(self)
+        start = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        first = legacy_series_helper(u1, start, 4)
+        child = Post.query.filter(Post.id != first.id).first()
+
+        tester.put(
+            f"/api/tasks/{child.id}",
+            json={
+                "body": "every other day",
+                "start_time": 60,
+                "end_time": 120,
+                "frequency": 2,
+                "to_date": None,
+                "color": "#fff",
+                "done": False,
+                "single_event": False,
+            },
+            headers=headers,
+        )
+        tasks = Post.query.order_by(Post.date).all()
+
+        self.assertEqual({task.body for task in tasks}, {"every other day"})
+        self.assertEqual([task.done for task in tasks], [False, True, False, True])
+
+    def test_complete_series_occurrence(self):
+        """Tests that completing one occurrence of a series leaves the rest due."""
+        tester = self.app.test_client()
+        login_helper(self, tester)
+        u1 = User.query.filter_by(username="dave").first()
+        today = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        series = Post(
+            body="daily",
+            date=today - timedelta(days=1),
+            to_date=today + timedelta(days=1),
+            user_id=u1.id,
+            frequency=1,
+        )
+        db.session.add(series)
+        db.session.commit()
+        ident = series.id
+
+        tester.get(f"/complete?id={ident}")
+        u1 = User.query.filter_by(username="dave").first()
+        tomorrow_date = today + timedelta(days=1)
+
+        self.assertFalse(Post.query.get(ident).done)
+        self.assertEqual(u1.get_daily_tasks(today.strftime("%d-%m-%Y")), [])
+        self.assertEqual(
+            [task.id for task in u1.get_daily_tasks(tomorrow_date.strftime("%d-%m-%Y"))],
+            [ident],
+        )
+
+    def test_complete_occurrence_on_local_day_once(self):
+        """Tests that completing uses the user's local day and repeating it adds nothing."""
+        tester = self.app.test_client()
+        login_helper(self, tester)
+        u1 = User.query.filter_by(username="dave").first()
+        today = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        u1.utc_offset = 14 * 60 if datetime.utcnow().hour >= 10 else -12 * 60
+        local_day = today + timedelta(days=1 if u1.utc_offset > 0 else -1)
+        series = Post(
+            body="daily",
+            date=today - timedelta(days=2),
+            to_date=today + timedelta(days=2),
+            user_id=u1.id,
+            frequency=1,
+        )
+        db.session.add(series)
+        db.session.commit()
+        ident, user_id = series.id, u1.id
+
+        tester.get(f"/complete?id={ident}")
+        tester.get(f"/complete?id={ident}")
+
+        overrides = Post.query.filter(Post.exclude == ident, Post.id != ident).all()
+        self.assertEqual([(task.date, task.done) for task in overrides], [(local_day, True)])
+        counts = User.query.get(user_id).completion_counts(local_day, local_day)
+        self.assertEqual(counts[local_day], [1, 1])
+
+    def test_compact_series_command(self):
+        """Tests that series stored per occurrence are converted into rules with sparse overrides."""
+        u1, u2 = user_creation_helper(self)
+        start = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        first = legacy_series_helper(u1, start, 4, interval=2)
+        done = Post.query.filter_by(date=start + timedelta(days=4)).first()
+        done.done = True
+        db.session.commit()
+        ident = u1.id
+        before = u1.get_tasks_in_range(start, start + timedelta(days=8))
+        before = {day: [task.body for task in tasks] for day, tasks in before.items()}
+        cli.register(self.app)
+
+        result = self.app.test_cli_runner().invoke(args=["series", "compact"])
+        u1 = User.query.get(ident)
+        after = u1.get_tasks_in_range(start, start + timedelta(days=8))
+
+        self.assertIn("Compacted 1 series", result.output)
+        self.assertEqual(u1.posts.count(), 2)
+        self.assertEqual(
+            {day: [task.body for task in tasks] for day, tasks in after.items()}, before
+        )
+
+    def test_check_queues_push(self):
+        """Tests that /check adds the notification to the outbox and the worker sends it."""
+        tester = self.app.test_client()
+        endpoint = PushEndpoint()
+        u1, task = push_user_helper(self, tester, endpoint)
+
+        response = tester.get(f"/check?id={task.id}")
+        run_worker(self.app, once=True)
+        endpoint.close()
+
+        self.assertEqual(json.loads(response.data), {"id": task.id})
+        self.assertEqual(len(endpoint.requests), 1)
+        self.assertIn("vapid", endpoint.requests[0][1]["authorization"])
+
+    def test_push_retries_and_drops_expired_subscription(self):
+        """Tests that failed pushes are retried and expired subscriptions removed."""
+        tester = self.app.test_client()
+        endpoint = PushEndpoint(500, 503, 201, 410)
+        u1, task = push_user_helper(self, tester, endpoint)
+        ident = u1.id
+
+        tester.get(f"/check?id={task.id}")
+        run_worker(self.app, once=True)
+        subscribed = PushSubscription.query.filter_by(user_id=ident).count()
+        tester.get(f"/check?id={task.id}")
+        run_worker(self.app, once=True)
+        db.session.remove()
+        endpoint.close()
+
+        self.assertEqual(len(endpoint.requests), 4)
+        self.assertEqual(subscribed, 1)
+        self.assertEqual(PushSubscription.query.filter_by(user_id=ident).count(), 0)
+
+    def test_subscribe_dedups_devices_by_endpoint(self):
+        """Tests that each device is stored once, for the user that subscribed it last."""
+        tester = self.app.test_client()
+        endpoint = PushEndpoint()
+        login_helper(self, tester)
+        phone, laptop = endpoint.subscription("/phone"), endpoint.subscription("/laptop")
+        other = User(username="other", email="other@example.com")
+        db.session.add(other)
+        db.session.commit()
+        other.add_push_subscription(phone)
+        db.session.commit()
+
+        for device in (phone, laptop, phone):
+            tester.post("/subscribe/", json={"sub_token": device})
+        endpoint.close()
+        u1 = User.query.filter_by(username="dave").first()
+
+        self.assertEqual(
+            sorted(device.endpoint for device in u1.push_subscriptions),
+            sorted([phone["endpoint"], laptop["endpoint"]]),
+        )
+        self.assertEqual(other.push_subscriptions.count(), 0)
+
+    def test_push_fans_out_to_devices_over_shared_session(self):
+        """Tests that a notification reaches every device over reused connections."""
+        tester = self.app.test_client()
+        endpoint = PushEndpoint()
+        u1, task = push_user_helper(self, tester, endpoint)
+        for path in ("/laptop", "/tablet", "/watch"):
+            u1.add_push_subscription(endpoint.subscription(path))
+        db.session.commit()
+
+        with QueryCounter() as queries:
+            tester.get(f"/check?id={task.id}")
+        tester.get(f"/check?id={task.id}")
+        run_worker(self.app, once=True)
+        endpoint.close()
+
+        self.assertEqual(
+            sorted({request[0] for request in endpoint.requests}),
+            ["/laptop", "/push", "/tablet", "/watch"],
+        )
+        self.assertEqual(len(endpoint.requests), 8)
+        self.assertLessEqual(len(endpoint.connections), self.app.config["PUSH_WORKERS"])
+        self.assertEqual(queries.full_scans(), [])
+
+    def test_vapid_headers_cached_by_audience(self):
+        """Tests that VAPID headers are reused per push service until close to expiry."""
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        self.app.config["VAPID_PRIVATE_KEY"] = b64urlencode(
+            key.private_numbers().private_value.to_bytes(32, "big")
+        )
+        cache = VapidCache()
+
+        first = cache.get(self.app, "https://push.example.com/a")
+        second = cache.get(self.app, "https://push.example.com/b")
+        cache.get(self.app, "https://other.example.com/a")
+        self.app.config["VAPID_REFRESH"] = self.app.config["VAPID_EXPIRY"]
+        cache.get(self.app, "https://push.example.com/a")
+
+        self.assertEqual(first, second)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 3, "hit_ratio": 0.25})
+
+    def test_push_benchmark(self):
+        """Tests that the push benchmark sends to the stand-in push service."""
+        uncached, cached, stats = push_benchmark.benchmark(self.app, 5)
+
+        self.assertGreater(cached, 0)
+        self.assertEqual((stats["hits"], stats["misses"]), (5, 5))
+
+    def test_send_email_batches_over_pooled_connections(self):
+        """Tests that pooled emails share SMTP connections and all arrive."""
+        smtp = SMTPStandIn()
+        smtp.configure(self.app)
+        smtp.gate.clear()
+
+        for number in range(10):
+            mail_queue.send(
+                self.app,
+                EmailMessage(
+                    f"email {number}", sender="admin@example.com", recipients=["a@b.c"]
+                ),
+            )
+        smtp.gate.set()
+        mail_queue.shutdown()
+        smtp.close()
+
+        self.assertEqual(len(smtp.messages), 10)
+        self.assertLessEqual(smtp.connections, 2 * self.app.config["MAIL_WORKERS"])
+
+    def test_outbox_worker_delivers_follow_request(self):
+        """Tests that the follow request email is only sent by the outbox worker."""
+        tester = self.app.test_client()
+        login_helper(self, tester)
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add(u2)
+        db.session.commit()
+        cli.register(self.app)
+
+        with mail.record_messages() as outbox:
+            tester.get("/follow_request/susan")
+            pending = [row.status for row in Outbox.query]
+            result = self.app.test_cli_runner().invoke(args=["outbox-worker", "--once"])
+
+        self.assertEqual(pending, ["pending"])
+        self.assertIn("Delivered 1 outbox rows", result.output)
+        self.assertEqual([msg.recipients for msg in outbox], [["susan@example.com"]])
+        self.assertEqual([row.status for row in Outbox.query], ["sent"])
+
+    def test_outbox_claims_are_exclusive(self):
+        """Tests that concurrent workers never claim the same row, until a lease lapses."""
+        for number in range(5):
+            send_email(f"email {number}", "admin@example.com", ["a@b.c"], "text", None)
+        db.session.commit()
+
+        first = [row.id for row in Outbox.claim("first", 3, 60)]
+        second = [row.id for row in Outbox.claim("second", 3, 60)]
+        third = Outbox.claim("third", 3, 60)
+        Outbox.query.filter_by(locked_by="first").update(
+            {Outbox.locked_until: datetime.utcnow() - timedelta(seconds=1)}
+        )
+        db.session.commit()
+        reclaimed = [row.id for row in Outbox.claim("fourth", 5, 60)]
+
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(second), 2)
+        self.assertFalse(set(first) & set(second))
+        self.assertEqual(third, [])
+        self.assertEqual(reclaimed, first)
+
+    def test_outbox_retries_then_fails(self):
+        """Tests that undeliverable rows are retried, then given up on once."""
+        smtp = SMTPStandIn()
+        smtp.configure(self.app)
+        smtp.close()
+        self.app.config["OUTBOX_MAX_ATTEMPTS"] = 3
+        send_email("email", "admin@example.com", ["a@b.c"], "text", None, key="once")
+        send_email("email", "admin@example.com", ["a@b.c"], "text", None, key="once")
+        db.session.commit()
+
+        run_worker(self.app, once=True)
+        rows = Outbox.query.all()
+
+        self.assertEqual([(row.status, row.attempts) for row in rows], [("failed", 3)])
+        self.assertIsNotNone(rows[0].last_error)
+
+    def test_outbox_duplicate_key_keeps_the_callers_change(self):
+        """Tests that a row whose key another worker added is skipped, not failed."""
+        db.session.execute(
+            Outbox.__table__.insert().values(kind="email", payload="{}", key="once")
+        )
+        db.session.add(User(username="susan", email="susan@example.com"))
+
+        first = Outbox.email("email", "admin@example.com", ["a@b.c"], "text", None, key="once")
+        second = Outbox.email("email", "admin@example.com", ["a@b.c"], "text", None, key="twice")
+        db.session.commit()
+
+        self.assertIsNone(first)
+        self.assertEqual(second.key, "twice")
+        self.assertEqual(Outbox.query.count(), 2)
+        self.assertIsNotNone(User.query.filter_by(username="susan").first())
+
+    def test_outbox_gives_up_waiting_after_the_lease(self):
+        """Tests that emails with no delivery result within the lease are marked failed."""
+        smtp = SMTPStandIn()
+        smtp.configure(self.app)
+        smtp.gate.clear()
+        self.app.config["OUTBOX_LEASE"] = 0.2
+        send_email("email", "admin@example.com", ["a@b.c"], "text", None)
+        db.session.commit()
+
+        deliver_batch(self.app, Outbox.claim("worker", 1, 0.2))
+        smtp.gate.set()
+        row = Outbox.query.one()
+
+        self.assertEqual((row.status, row.attempts), ("pending", 1))
+        self.assertEqual(row.last_error, "no delivery result within the lease")
+
+    def test_mail_queue_backpressure_and_drain(self):
+        """Tests that a full queue turns senders away and shutdown drains it."""
+        smtp = SMTPStandIn()
+        smtp.configure(self.app)
+        smtp.gate.clear()
+        self.app.config.update(MAIL_WORKERS=1, MAIL_QUEUE_SIZE=1, MAIL_QUEUE_TIMEOUT=0.1)
+        queue = MailQueue()
+        messages = [
+            EmailMessage(f"email {number}", sender="admin@example.com", recipients=["a@b.c"])
+            for number in range(3)
+        ]
+
+        queued = [queue.send(self.app, messages[0])]
+        while not queue.queue.empty():
+            time.sleep(0.01)
+        queued += [queue.send(self.app, msg) for msg in messages[1:]]
+        smtp.gate.set()
+        queue.shutdown()
+        smtp.close()
+
+        self.assertEqual(queued, [True, True, False])
+        self.assertEqual(len(smtp.messages), 2)
+        self.assertEqual(queue.workers, [])
+
+    def test_reminder_scheduler_fires_due_tasks(self):
+        """Tests that the scheduler pushes task and recurring occurrence reminders when they end."""
+        tester = self.app.test_client()
+        endpoint = PushEndpoint()
+        u1, task = push_user_helper(self, tester, endpoint)
+        today = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        task.date, task.start_time, task.end_time = today, 60, 120
+        db.session.add(
+            Post(
+                body="daily",
+                date=today - timedelta(days=1),
+                user_id=u1.id,
+                frequency=1,
+                start_time=60,
+                end_time=120,
+            )
+        )
+        db.session.commit()
+        scheduler = ReminderScheduler(self.app, horizon=timedelta(days=2))
+
+        early = scheduler.tick(today + timedelta(minutes=119))
+        due = scheduler.tick(today + timedelta(minutes=120))
+        push.join()
+        endpoint.close()
+
+        self.assertEqual(early, [])
+        self.assertEqual(sorted(reminder.body for reminder in due), ["daily", "stretch"])
+        self.assertEqual(len(endpoint.requests), 2)
+        self.assertEqual(scheduler.next_due(), today + timedelta(days=1, minutes=120))
+
+    def test_reminder_scheduler_reloads_changed_tasks(self):
+        """Tests that edited and completed tasks are rescheduled on the next tick."""
+        u1, u2 = user_creation_helper(self)
+        today = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        moved = Post(body="moved", date=today, user_id=u1.id, start_time=0, end_time=60)
+        completed = Post(
+            body="completed", date=today, user_id=u1.id, start_time=0, end_time=90
+        )
+        db.session.add_all([moved, completed])
+        db.session.commit()
+        moved_id, completed_id = moved.id, completed.id
+        scheduler = ReminderScheduler(self.app)
+        scheduler.tick(today)
+
+        Post.query.get(moved_id).end_time = 30
+        Post.query.get(completed_id).done = True
+        User.query.get(u1.id).sync_occurrences(Post.query.get(moved_id))
+        db.session.commit()
+        due = scheduler.tick(today + timedelta(minutes=120))
+
+        self.assertEqual(
+            [(reminder.body, reminder.due) for reminder in due],
+            [("moved", today + timedelta(minutes=30))],
+        )
+
+    def test_reminders_follow_user_timezone(self):
+        """Tests that reminders are due at the task's end in the user's local time."""
+        tester = self.app.test_client()
+        login_helper(self, tester)
+        u1 = User.query.filter_by(username="dave").first()
+        today = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        db.session.add(Post(body="late", date=today, user_id=u1.id, start_time=0, end_time=60))
+        db.session.commit()
+
+        response = tester.post("/timezone", json={"offset": 120})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(tester.post("/timezone", json={"offset": "+2"}).status_code, 400)
+        reminders = User.query.get(u1.id).reminders(
+            today - timedelta(days=1), today + timedelta(days=1)
+        )
+
+        self.assertEqual(
+            [reminder.due for reminder in reminders], [today - timedelta(minutes=60)]
+        )
+
+    def test_reminder_benchmark(self):
+        """Tests that the reminder benchmark reports scheduling and firing rates."""
+        result = CliRunner().invoke(reminders_benchmark.main, ["--count", "1000", "--users", "10"])
+
+        self.assertIn("Scheduled 1000 reminders", result.output)
+        self.assertIn("Fired 1000 reminders", result.output)
+
+    def test_query_budget_index(self):
+        """Tests the number of queries and index use of the index page."""
+        tester = self.app.test_client()
+        login_helper(self, tester)
+        add_and_edit_task_helper(self, 2)
+        u1 = User.query.filter_by(username="dave").first()
+        start = datetime.strptime(date, "%Y-%m-%d %H:%M:%S") - timedelta(days=3)
+        db.session.add(Post(body="daily", date=start, user_id=u1.id, frequency=1))
+        db.session.commit()
+
+        with QueryCounter() as queries, fresh_context_helper(self):
+            response = tester.get("index/ph")
+
+        self.assertIn(b"daily", response.data)
+        self.assertLessEqual(queries.count, 4)
+        self.assertEqual(queries.full_scans(), [])
+
+    def test_query_budget_get_daily_tasks(self):
+        """Tests the number of queries and index use of get_daily_tasks."""
+        u1, u2 = user_creation_helper(self)
+        start = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        db.session.add(Post(body="daily", date=start, user_id=u1.id, frequency=1))
+        db.session.commit()
+
+        ident = u1.id
+        db.session.remove()
+        u1 = User.query.get(ident)
+
+        with QueryCounter() as queries:
+            u1.get_daily_tasks(tomorrow)
+        self.assertLessEqual(queries.count, 3)
+        self.assertEqual(queries.full_scans(), [])
+
+        u1.rebuild_occurrences()
+        db.session.commit()
+        db.session.remove()
+        u1 = User.query.get(ident)
+        with QueryCounter() as queries:
+            u1.get_daily_tasks(tomorrow)
+        self.assertLessEqual(queries.count, 3)
+        self.assertEqual(queries.full_scans(), [])
+
+    def test_query_budget_messages_and_contacts(self):
+        """Tests the number of queries and index use of the messages and contacts pages."""
+        tester = self.app.test_client()
+        login_helper(self, tester)
+        message_helper(self)
+
+        for page, budget in (("messages", 7), ("sent_messages", 7), ("contacts", 7)):
+            with QueryCounter() as queries, fresh_context_helper(self):
+                response = tester.get(page)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(queries.count, budget, page)
+            self.assertEqual(queries.full_scans(), [], page)
+
+    def test_query_budget_api(self):
+        """Tests the number of queries and index use of the api endpoints."""
+        tester = self.app.test_client()
+        u1, headers = api_user_helper(self)
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add(u2)
+        u2.follow(u1)
+        start = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        db.session.add(Post(body="daily", date=start, user_id=u1.id, frequency=1))
+        db.session.add(Message(author=u2, recipient=u1, body="test"))
+        db.session.commit()
+        today = datetime.strftime(start, "%d-%m-%Y")
+        tester.get("/api/tokens/cache", headers=headers)
+
+        for url, budget in (
+            (f"/api/tasks/{u1.id}/{today}", 3),
+            (f"/api/tasks/{u1.id}?from={today}&to={tomorrow}", 4),
+            (f"/api/messages/received/{u1.id}", 4),
+            (f"/api/messages/sent/{u1.id}", 4),
+            ("/api/users", 4),
+            (f"/api/users/{u1.id}/followers", 5),
+            (f"/api/users/{u1.id}/followed", 2),
+        ):
+            with QueryCounter() as queries, fresh_context_helper(self):
+                response = tester.get(url, headers=headers, buffered=True)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertLessEqual(queries.count, budget, url)
+            self.assertEqual(queries.full_scans(), [], url)
+
+    def test_api_user_collection_counts(self):
+        """Tests user collections count posts and follows per page, not per user."""
+        tester = self.app.test_client()
+        u1, headers = api_user_helper(self)
+        for position in range(30):
+            user = User(username=f"user{position}", email=f"user{position}@example.com")
+            db.session.add(user)
+            user.follow(u1)
+            if position % 2:
+                u1.follow(user)
+            db.session.add(Post(body="task", user_id=u1.id))
+        db.session.commit()
+        tester.get("/api/tokens/cache", headers=headers)
+
+        for url, items, count in (
+            ("/api/users", 31, 4),
+            (f"/api/users/{u1.id}/followers", 30, 5),
+            (f"/api/users/{u1.id}/followed", 15, 5),
+        ):
+            with QueryCounter() as queries, fresh_context_helper(self):
+                response = tester.get(url, headers=headers)
+            data = response.get_json()
+            self.assertEqual(len(data["items"]), items, url)
+            self.assertEqual(queries.count, count, url)
+            self.assertEqual(queries.full_scans(), [], url)
+            for item in data["items"]:
+                user = User.query.get(item["id"])
+                self.assertEqual(item["post_count"], user.posts.count())
+                self.assertEqual(item["follower_count"], user.followers.count())
+                self.assertEqual(item["followed_count"], user.followed.count())
+
+    def test_api_sparse_fieldsets(self):
+        """Tests ?fields= limits the keys returned and the columns and counts loaded."""
+        tester = self.app.test_client()
+        u1, headers = api_user_helper(self)
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add(u2)
+        u1.follow(u2)
+        start = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        db.session.add(Post(body="task", date=start, user_id=u1.id, color="red"))
+        db.session.add(Message(author=u2, recipient=u1, body="test"))
+        db.session.commit()
+        ident, followed = u1.id, u2.id
+        tester.get("/api/tokens/cache", headers=headers)
+
+        url = f"/api/users/{ident}/followed?fields=id,username"
+        with QueryCounter() as queries, fresh_context_helper(self):
+            response = tester.get(url, headers=headers)
+        data = response.get_json()
+        self.assertEqual(data["items"], [{"id": followed, "username": "susan"}])
+        self.assertIn("fields=id%2Cusername", data["_links"]["self"])
+        self.assertEqual(queries.count, 2)
+        self.assertNotIn("password_hash", queries.statements[-1][0])
+
+        response = tester.get("/api/users?fields=id,follower_count", headers=headers)
+        counts = {item["id"]: item["follower_count"] for item in response.get_json()["items"]}
+        self.assertEqual(counts, {ident: 0, followed: 1})
+
+        response = tester.get(
+            f"/api/messages/received/{ident}?fields=body", headers=headers
+        )
+        self.assertEqual(response.get_json()["items"], [{"body": "test"}])
+        response = tester.get(
+            f"/api/tasks/{ident}/{start:%d-%m-%Y}?fields=body,color", headers=headers
+        )
+        self.assertEqual(response.get_json()["items"], [{"body": "task", "color": "red"}])
+
+        response = tester.get("/api/users?fields=id,password_hash", headers=headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("password_hash", response.get_json()["message"])
+
+    def test_api_fields_benchmark(self):
+        """Tests that the fields benchmark compares full and sparse responses."""
+        user = fields_benchmark.seed(contacts=3, messages=3, tasks=3)
+
+        results = fields_benchmark.benchmark(self.app, user, repeat=1)
+
+        self.assertEqual([result[0] for result in results], ["contacts", "inbox", "day"])
+        for screen, full_bytes, full_ms, sparse_bytes, sparse_ms in results:
+            self.assertLess(sparse_bytes, full_bytes)
+
+    def test_api_cursor_pagination(self):
+        """Tests users and messages are paged by cursor when asked, users by offset by default."""
+        tester = self.app.test_client()
+        u1, headers = api_user_helper(self)
+        for position in range(7):
+            db.session.add(User(username=f"user{position % 3}", email=f"{position}@b.c"))
+        start = datetime(2020, 1, 1)
+        for position in range(9):
+            db.session.add(
+                Message(
+                    sender_id=u1.id,
+                    recipient_id=u1.id,
+                    body=str(position),
+                    timestamp=start + timedelta(minutes=position // 2),
+                )
+            )
+        db.session.commit()
+        expected = [
+            user.id for user in User.query.order_by(User.username, User.id)
+        ]
+
+        seen, url = [], "/api/users?per_page=3&cursor="
+        while url:
+            data = tester.get(url, headers=headers).get_json()
+            self.assertNotIn("total_items", data["_meta"])
+            seen += [item["id"] for item in data["items"]]
+            url = data["_links"]["next"]
+        self.assertEqual(seen, expected)
+        data = tester.get(data["_links"]["prev"], headers=headers).get_json()
+        self.assertEqual([item["id"] for item in data["items"]], expected[3:6])
+
+        data = tester.get("/api/users?page=2&per_page=3", headers=headers).get_json()
+        self.assertEqual(data["_meta"]["total_items"], 8)
+        for url in ("/api/users?per_page=3", f"/api/users/{u1.id}/followers"):
+            data = tester.get(url, headers=headers).get_json()
+            self.assertIn("total_pages", data["_meta"], url)
+            self.assertIn("total_items", data["_meta"], url)
+        response = tester.get("/api/users?cursor=bogus", headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+        bodies, url = [], f"/api/messages/received/{u1.id}?per_page=4"
+        while url:
+            data = tester.get(url, headers=headers).get_json()
+            bodies += [item["body"] for item in data["items"]]
+            url = data["_links"]["next"]
+        self.assertEqual(bodies, [str(position) for position in reversed(range(9))])
+        for values in ([123, 1], ["not a date", 1], [None, 1]):
+            cursor = encode_cursor("n", values)
+            response = tester.get(
+                f"/api/messages/received/{u1.id}?cursor={cursor}", headers=headers
+            )
+            self.assertEqual(response.status_code, 400, values)
+
+    def test_api_streams_unbounded_collections(self):
+        """Tests whole inboxes and daily tasks stream as JSON or NDJSON."""
+        tester = self.app.test_client()
+        u1, headers = api_user_helper(self)
+        url = f"/api/messages/received/{u1.id}"
+        self.assertEqual(tester.get(url, headers=headers).get_json(), {"items": []})
+        for position in range(3):
+            db.session.add(Message(sender_id=u1.id, recipient_id=u1.id, body=str(position)))
+        start = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        db.session.add(
+            Post(body="daily", date=start, to_date=start, user_id=u1.id, frequency=1)
+        )
+        db.session.commit()
+
+        tasks_url = f"/api/tasks/{u1.id}/{start:%d-%m-%Y}"
+
+        with fresh_context_helper(self):
+            response = tester.get(url, headers=headers)
+            self.assertTrue(response.is_streamed)
+            items = response.get_json()["items"]
+            response = tester.get(url, headers={**headers, "Accept": "application/x-ndjson"})
+            lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual([item["body"] for item in items], ["2", "1", "0"])
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        self.assertEqual([json.loads(line)["body"] for line in lines], ["2", "1", "0"])
+
+        response = tester.get(tasks_url, headers=headers)
+        self.assertEqual(response.get_json()["items"][0]["to_date"], f"{start:%d-%m-%Y}")
+
+    def test_stream_benchmark(self):
+        """Tests that streaming an inbox peaks at less memory than listing it."""
+        ((size, list_kib, list_s, stream_kib, stream_s),) = stream_benchmark.benchmark((5000,))
+
+        self.assertLess(stream_kib * 2, list_kib)
+
+    def test_messages_page_cursor_links(self):
+        """Tests the messages page links to the next page with a cursor."""
+        self.app.config["POSTS_PER_PAGE"] = 2
+        tester = self.app.test_client()
+        login_helper(self, tester)
+        user = User.query.filter_by(username="dave").first()
+        for position in range(3):
+            db.session.add(Message(sender_id=user.id, recipient_id=user.id, body=f"m{position}"))
+        db.session.commit()
+
+        response = tester.get("/messages")
+        next_url = re.search(r'href="(/messages\?cursor=[^"]+)"', response.data.decode())
+        response = tester.get(next_url.group(1).replace("&amp;", "&"))
+        self.assertIn(b"m0", response.data)
+        self.assertNotIn(b"m2", response.data)
+        self.assertIn(b"Previous page", response.data)
+        self.assertEqual(tester.get("/messages?page=2").status_code, 200)
+
+    def test_pagination_benchmark(self):
+        """Tests that the pagination benchmark compares offset and cursor paging."""
+        result = CliRunner().invoke(
+            pagination_benchmark.main, ["--count", "3000", "--per-page", "25"]
+        )
+
+        self.assertIn("page 100: offset", result.output)
+        self.assertNotIn("page 1000:", result.output)
+
+    def test_api_users_by_ids(self):
+        """Tests ?ids= loads users in one query and reports missing ids per item."""
+        tester = self.app.test_client()
+        u1, headers = api_user_helper(self)
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add(u2)
+        u2.follow(u1)
+        db.session.commit()
+        url = f"/api/users?ids={u2.id},999,{u1.id},{u2.id}"
+        tester.get("/api/tokens/cache", headers=headers)
+
+        with QueryCounter() as queries, fresh_context_helper(self):
+            response = tester.get(url, headers=headers)
+        items = response.get_json()["items"]
+        self.assertEqual(queries.count, 4)
+        self.assertEqual([item["id"] for item in items], [u2.id, 999, u1.id])
+        self.assertEqual(items[1], {"id": 999, "error": "Not Found"})
+        self.assertEqual(items[0]["followed_count"], 1)
+        self.assertEqual(items[2]["follower_count"], 1)
+
+        response = tester.get(f"/api/users/A{u1.id}A999", headers=headers)
+        self.assertEqual([item["id"] for item in response.get_json()], [u1.id, 999])
+        response = tester.get("/api/users?ids=1,two", headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_api_token_cache(self):
+        """Tests verified tokens skip the token query until revoked or replaced."""
+        tester = self.app.test_client()
+        u1, headers = api_user_helper(self)
+        url = f"/api/users/{u1.id}/completion?from=01-01-2020&to=02-01-2020"
+        hits = token_cache.hits
+
+        tester.get(url, headers=headers)
+        with QueryCounter() as queries:
+            response = tester.get(url, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(any("user.token = ?" in statement for statement, _ in queries.statements))
+        stats = tester.get("/api/tokens/cache", headers=headers).get_json()
+        self.assertEqual(stats["hits"], hits + 2)
+        self.assertGreater(stats["hit_ratio"], 0)
+
+        self.assertEqual(tester.delete("/api/tokens", headers=headers).status_code, 204)
+        self.assertEqual(tester.get(url, headers=headers).status_code, 401)
+
+        user = User.query.get(u1.id)
+        old = {"Authorization": f"Bearer {user.get_token(expires_in=30)}"}
+        db.session.commit()
+        self.assertEqual(tester.get(url, headers=old).status_code, 200)
+        new = {"Authorization": f"Bearer {user.get_token()}"}
+        db.session.commit()
+        self.assertEqual(tester.get(url, headers=old).status_code, 401)
+        self.assertEqual(tester.get(url, headers=new).status_code, 200)
+
+        db.session.delete(user)
+        db.session.commit()
+        self.assertEqual(tester.get(url, headers=new).status_code, 401)
+
+    def test_api_token_cache_skips_queries(self):
+        """Tests a cached token is verified without a query in a fresh app context."""
+        tester = self.app.test_client()
+        u1, headers = api_user_helper(self)
+        ident = u1.id
+        tester.get("/api/tokens/cache", headers=headers)
+
+        with QueryCounter() as queries, fresh_context_helper(self):
+            for _ in range(3):
+                response = tester.get("/api/tokens/cache", headers=headers)
+                self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries.count, 0)
+
+        with fresh_context_helper(self):
+            self.assertEqual(tester.delete("/api/tokens", headers=headers).status_code, 204)
+        self.assertEqual(tester.get("/api/tokens/cache", headers=headers).status_code, 401)
+
+        user = User.query.get(ident)
+        headers = {"Authorization": f"Bearer {user.get_token()}"}
+        db.session.commit()
+        tester.get("/api/tokens/cache", headers=headers)
+        db.session.execute(User.__table__.delete().where(User.id == ident))
+        db.session.commit()
+        self.assertEqual(tester.delete("/api/tokens", headers=headers).status_code, 401)
+
+    def test_api_signed_tokens(self):
+        """Tests signed access tokens, refresh token rotation and revocation."""
+        self.app.config["API_TOKEN_MODE"] = "jwt"
+        tester = self.app.test_client()
+        u1 = User(username="api", email="api@example.com")
+        u1.set_password("test")
+        db.session.add(u1)
+        db.session.commit()
+        url = f"/api/users/{u1.id}/completion?from=01-01-2020&to=02-01-2020"
+        login = {"Authorization": "Basic " + base64.b64encode(b"api:test").decode()}
+
+        tokens = tester.post("/api/tokens", headers=login).get_json()
+        headers = {"Authorization": f"Bearer {tokens['token']}"}
+        tester.get(url, headers=headers)
+        with QueryCounter() as queries:
+            self.assertEqual(tester.get(url, headers=headers).status_code, 200)
+        for statement, _ in queries.statements:
+            self.assertNotIn("user.token = ?", statement)
+            self.assertNotIn("denied_token", statement)
+        forged = tokens["token"][:-2] + ("AA" if tokens["token"][-2:] != "AA" else "BB")
+        self.assertEqual(tester.get(url, headers={"Authorization": f"Bearer {forged}"}).status_code, 401)
+
+        refreshed = tester.post(
+            "/api/tokens/refresh", json={"refresh_token": tokens["refresh_token"]}
+        ).get_json()
+        self.assertNotEqual(refreshed["refresh_token"], tokens["refresh_token"])
+        reused = tester.post("/api/tokens/refresh", json={"refresh_token": tokens["refresh_token"]})
+        self.assertEqual(reused.status_code, 401)
+        response = tester.post(
+            "/api/tokens/refresh", json={"refresh_token": refreshed["refresh_token"]}
+        )
+        self.assertEqual(response.status_code, 401)
+
+        tokens = tester.post("/api/tokens", headers=login).get_json()
+        other = tester.post("/api/tokens", headers=login).get_json()
+        headers = {"Authorization": f"Bearer {tokens['token']}"}
+        self.assertEqual(tester.delete("/api/tokens", headers=headers).status_code, 204)
+        self.assertEqual(tester.get(url, headers=headers).status_code, 401)
+        self.assertEqual(DeniedToken.query.count(), 1)
+        response = tester.post("/api/tokens/refresh", json={"refresh_token": tokens["refresh_token"]})
+        self.assertEqual(response.status_code, 401)
+        response = tester.post("/api/tokens/refresh", json={"refresh_token": other["refresh_token"]})
+        self.assertEqual(response.status_code, 200)
+
+    def test_api_signed_tokens_skip_queries(self):
+        """Tests signed access tokens are verified without a query, and refresh fails for a deleted user."""
+        self.app.config["API_TOKEN_MODE"] = "jwt"
+        tester = self.app.test_client()
+        u1 = User(username="api", email="api@example.com")
+        u1.set_password("test")
+        db.session.add(u1)
+        db.session.commit()
+        ident = u1.id
+        login = {"Authorization": "Basic " + base64.b64encode(b"api:test").decode()}
+        tokens = tester.post("/api/tokens", headers=login).get_json()
+        headers = {"Authorization": f"Bearer {tokens['token']}"}
+        tester.get("/api/tokens/cache", headers=headers)
+
+        with QueryCounter() as queries, fresh_context_helper(self):
+            for _ in range(3):
+                response = tester.get("/api/tokens/cache", headers=headers)
+                self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries.count, 0)
+
+        db.session.delete(User.query.get(ident))
+        db.session.commit()
+        response = tester.post("/api/tokens/refresh", json={"refresh_token": tokens["refresh_token"]})
+        self.assertEqual(response.status_code, 401)
+        self.assertTrue(RefreshToken.query.filter_by(user_id=ident).first().revoked)
+
+    def test_token_benchmark(self):
+        """Tests that the token benchmark times every token mode."""
+        u1, headers = api_user_helper(self)
+
+        rates = tokens_benchmark.benchmark(self.app, u1, requests=5)
+
+        self.assertEqual(len(rates), 3)
+        self.assertTrue(all(rate > 0 for rate in rates))
+
+    def test_api_user_image(self):
+        """Tests user payloads link to a cached image unless inline images are asked for."""
+        tester = self.app.test_client()
+        u1, headers = api_user_helper(self)
+        image_cache.images.clear()
+
+        response = tester.get(f"/api/users/{u1.id}", headers=headers)
+        data = response.get_json()
+        self.assertNotIn("image", data)
+        digest = image_digest(u1.image_file)
+        self.assertEqual(data["image_url"], f"/api/users/{u1.id}/image/{digest}")
+
+        response = tester.get(data["image_url"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["ETag"], f'"{digest}"')
+        self.assertIn("immutable", response.headers["Cache-Control"])
+        with open(image_path(u1.image_file), "rb") as img_file:
+            self.assertEqual(response.data, img_file.read())
+        response = tester.get(data["image_url"], headers={"If-None-Match": f'"{digest}"'})
+        self.assertEqual(response.status_code, 304)
+        response = tester.get(f"/api/users/{u1.id}/image/stale")
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith(data["image_url"]))
+
+        response = tester.get("/api/users?inline_images=1", headers=headers)
+        data = response.get_json()
+        self.assertEqual(data["items"][0]["image"], u1.prep_image_for_json())
+        self.assertIn("inline_images=1", data["_links"]["self"])
+        self.assertEqual(len(image_cache.images), 1)
+
 
 def user_creation_helper(self):
     u1 = User(username="john", email="john@example.com")
@@ -757,6 +2245,52 @@ def user_creation_helper(self):
     return u1, u2
 
 
+def api_user_helper(self):
+    """Helper to create a user with an api token."""
+    u1 = User(username="api", email="api@example.com")
+    db.session.add(u1)
+    db.session.commit()
+    token = u1.get_token()
+    db.session.commit()
+    return u1, {"Authorization": f"Bearer {token}"}
+
+
+@contextmanager
+def fresh_context_helper(self):
+    """
+    Pops the test's app context so that each request runs in its own
+    app context and session, as in production, instead of finding rows
+    in the identity map of the test's session.
+    """
+    self.app_context.pop()
+    try:
+        yield
+    finally:
+        self.app_context.push()
+
+
+def legacy_series_helper(user, start, occurrences, interval=1):
+    """Helper to add a time limited series stored as one task per occurrence."""
+    tasks = [
+        Post(
+            body="daily",
+            date=start + timedelta(days=interval * position),
+            to_date=start + timedelta(days=interval * (occurrences - 1)),
+            user_id=user.id,
+            start_time=60,
+            end_time=120,
+            done=False,
+        )
+        for position in range(occurrences)
+    ]
+    db.session.add_all(tasks)
+    db.session.flush()
+    for task in tasks:
+        task.exclude = tasks[0].id
+    db.session.commit()
+    return tasks[0]
+
+
 def login_helper(self, client):
     """Helper to register and log in a user to the db."""
     u1 = User(username="dave", email="john@example.com")
@@ -770,6 +2304,22 @@ def login_helper(self, client):
     return response
 
 
+def push_user_helper(self, tester, endpoint):
+    """Helper to log in a user subscribed to notifications at endpoint, with a task."""
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    self.app.config["VAPID_PRIVATE_KEY"] = b64urlencode(
+        key.private_numbers().private_value.to_bytes(32, "big")
+    )
+    login_helper(self, tester)
+    u1 = User.query.filter_by(username="dave").first()
+    u1.subscribed = True
+    u1.add_push_subscription(endpoint.subscription())
+    task = Post(body="stretch", date=datetime.utcnow(), user_id=u1.id)
+    db.session.add(task)
+    db.session.commit()
+    return u1, task
+
+
 def contacts_helper(self):
     u1 = User.query.filter_by(username="dave").first()
     u2 = User(username="susan", email="susan@example.com")